@@ -1,24 +1,37 @@
 import os
+import re
+import uuid
+import tempfile
+import hashlib
 import math
 import logging
 import csv
 import json
+import time
+import queue
+import atexit
+import threading
+from typing import NamedTuple
+from functools import lru_cache
+from collections import defaultdict, Counter
 from io import TextIOWrapper
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timedelta, time as dtime
 
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, flash, jsonify, Response
+    session, flash, jsonify, Response, make_response, send_file,
+    stream_with_context
 )
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import func, text, select
+from sqlalchemy import func, text, select, literal, and_, or_, update, extract
+from sqlalchemy.orm import selectinload, raiseload
+from sqlalchemy.exc import OperationalError, InterfaceError
 
 # ✅ XLSX export support
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment
-from openpyxl.utils import get_column_letter
+import xlsxwriter
 
 # -----------------------------
 # Timezone (Windows-safe)
@@ -39,10 +52,42 @@ except Exception:
     APP_TZ = None
     UTC_TZ = None
 
+# -----------------------------
+# JSON (orjson optional)
+# -----------------------------
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+class AppJSONProvider(DefaultJSONProvider):
+    """
+    API datetimes are naive UTC; encode them as ISO-8601 with a trailing "Z".
+    Uses orjson when installed (datetimes formatted in C), else the stdlib encoder.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, datetime):
+            if o.tzinfo is None:
+                return o.isoformat() + "Z"
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and "indent" not in kwargs:
+            return orjson.dumps(
+                obj,
+                default=self.default,
+                option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_SORT_KEYS,
+            ).decode("utf-8")
+        return super().dumps(obj, **kwargs)
+
 # -----------------------------
 # App + Config
 # -----------------------------
 app = Flask(__name__)
+app.json = AppJSONProvider(app)
 
 # Basic INFO logging (Render captures these)
 logging.basicConfig(level=logging.INFO)
@@ -94,6 +139,19 @@ else:
 
 app.config["SQLALCHEMY_DATABASE_URI"] = db_url
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_RECORD_QUERIES"] = False
+
+# Explicit pool for Postgres: each gunicorn worker runs 8 threads (see procfile)
+# plus the ping writer, so size the pool to cover them with burst headroom.
+# pre_ping drops connections Render closed while idle.
+if not db_url.startswith("sqlite"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": 5,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+    }
 
 db = SQLAlchemy(app)
 
@@ -258,7 +316,8 @@ class MobileEvent(db.Model):
     event_at = db.Column(db.DateTime, nullable=True)
     received_at = db.Column(db.DateTime, default=lambda: now_utc(), nullable=False)
 
-    raw_json = db.Column(db.Text, nullable=False)
+    # Only kept for non-location events or abnormal accuracy (see _bg_event_raw_json)
+    raw_json = db.Column(db.Text, nullable=True, default=None)
 
 class MobileIssueReport(db.Model):
     __tablename__ = "mobile_issue_reports"
@@ -270,6 +329,7 @@ class MobileIssueReport(db.Model):
 
     message = db.Column(db.Text, nullable=True)
     payload_json = db.Column(db.Text, nullable=False, default="{}")
+    payload_pretty = db.Column(db.Text, nullable=True)  # indented copy for the admin detail page
 
     status = db.Column(db.String(30), nullable=False, default="open")  # open / resolved / ignored
     resolved_by = db.Column(db.String(120), nullable=True)
@@ -282,6 +342,127 @@ class MobileIssueReport(db.Model):
     store = db.relationship("Store")
     shift = db.relationship("Shift")
 
+# -----------------------------
+# Store cache (stores change rarely but are read on every clock event)
+# -----------------------------
+class StoreSnapshot(NamedTuple):
+    id: int
+    name: str
+    qr_token: str
+    latitude: float
+    longitude: float
+    geofence_radius_m: int
+    # precomputed for store_distance_m()
+    lat_rad: float
+    lng_rad: float
+    cos_lat: float
+
+# TTL bounds staleness across gunicorn workers; local admin edits invalidate immediately
+STORE_CACHE_TTL_S = 60.0
+
+_STORE_BY_TOKEN: dict[str, StoreSnapshot] = {}
+_STORE_BY_ID: dict[int, StoreSnapshot] = {}
+_store_cache_loaded_at: float | None = None
+
+def invalidate_store_cache():
+    global _store_cache_loaded_at
+    _store_cache_loaded_at = None
+
+def _load_store_cache():
+    global _STORE_BY_TOKEN, _STORE_BY_ID, _store_cache_loaded_at
+    rows = db.session.execute(
+        select(Store.id, Store.name, Store.qr_token, Store.latitude, Store.longitude, Store.geofence_radius_m)
+    ).all()
+    by_token = {}
+    by_id = {}
+    for r in rows:
+        lat_rad = math.radians(r.latitude)
+        snap = StoreSnapshot(*r, lat_rad, math.radians(r.longitude), math.cos(lat_rad))
+        by_token[normalize_store_code(snap.qr_token)] = snap
+        by_id[snap.id] = snap
+    # Swap whole dicts so concurrent threads never see a half-built cache
+    _STORE_BY_TOKEN = by_token
+    _STORE_BY_ID = by_id
+    _store_cache_loaded_at = time.monotonic()
+
+def _store_cache_fresh() -> bool:
+    return (
+        _store_cache_loaded_at is not None
+        and (time.monotonic() - _store_cache_loaded_at) < STORE_CACHE_TTL_S
+    )
+
+def cached_stores() -> list[StoreSnapshot]:
+    if not _store_cache_fresh():
+        _load_store_cache()
+    return list(_STORE_BY_ID.values())
+
+def store_by_token(qr_token: str) -> StoreSnapshot | None:
+    tok = normalize_store_code(qr_token)
+    if not tok:
+        return None
+    if _store_cache_fresh():
+        snap = _STORE_BY_TOKEN.get(tok)
+        if snap:
+            return snap
+    # miss or stale: a store may have been added by another worker
+    _load_store_cache()
+    return _STORE_BY_TOKEN.get(tok)
+
+def store_by_id(store_id) -> StoreSnapshot | None:
+    if store_id is None:
+        return None
+    try:
+        store_id = int(store_id)
+    except (TypeError, ValueError):
+        return None
+    if _store_cache_fresh():
+        snap = _STORE_BY_ID.get(store_id)
+        if snap:
+            return snap
+    _load_store_cache()
+    return _STORE_BY_ID.get(store_id)
+
+# -----------------------------
+# Employee PIN cache (hot path: every ping / clock-out looks up by PIN)
+# -----------------------------
+class EmployeeSnapshot(NamedTuple):
+    id: int
+    name: str
+    active: bool
+
+# Short TTL bounds staleness across workers (e.g. a deactivation elsewhere)
+EMPLOYEE_CACHE_TTL_S = 30.0
+EMPLOYEE_CACHE_MAX = 5000
+
+_EMP_BY_PIN: dict[str, tuple[float, EmployeeSnapshot]] = {}
+
+def invalidate_employee_cache():
+    _EMP_BY_PIN.clear()
+
+def employee_by_pin(pin: str) -> EmployeeSnapshot | None:
+    """
+    (id, name, active) for a PIN. Misses aren't cached so bad PINs can't grow the cache.
+    """
+    hit = _EMP_BY_PIN.get(pin)
+    if hit and (time.monotonic() - hit[0]) < EMPLOYEE_CACHE_TTL_S:
+        return hit[1]
+
+    row = db.session.execute(
+        select(Employee.id, Employee.name, Employee.active)
+        .where(Employee.pin == pin)
+        .order_by(Employee.id.asc())
+        .limit(1)
+    ).first()
+    if not row:
+        _EMP_BY_PIN.pop(pin, None)
+        return None
+
+    if len(_EMP_BY_PIN) >= EMPLOYEE_CACHE_MAX:
+        _EMP_BY_PIN.clear()
+    snap = EmployeeSnapshot(row.id, row.name, bool(row.active))
+    _EMP_BY_PIN[pin] = (time.monotonic(), snap)
+    return snap
+
 # -----------------------------
 # Geo Helpers
 # -----------------------------
@@ -299,6 +480,31 @@ def haversine_m(lat1, lon1, lat2, lon2) -> float:
     c = 2.0 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
     return R * c
 
+def store_distance_m(store: StoreSnapshot, lat: float, lon: float) -> float:
+    """
+    Same as haversine_m() to a cached store, reusing its precomputed radians/cos(lat).
+    """
+    phi1 = math.radians(lat)
+    dphi = store.lat_rad - phi1
+    dlmb = store.lng_rad - math.radians(lon)
+
+    a = math.sin(dphi / 2.0) ** 2 + math.cos(phi1) * store.cos_lat * math.sin(dlmb / 2.0) ** 2
+    c = 2.0 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
+    return 6371000.0 * c
+
+def geofence_distance_m(store: StoreSnapshot, lat: float, lon: float) -> float:
+    """
+    store_distance_m(), but points obviously outside the fence (> 2x radius by an
+    equirectangular estimate: no trig beyond two radians()) skip the haversine.
+    The estimate is within a fraction of a percent at these ranges.
+    """
+    dphi = math.radians(lat) - store.lat_rad
+    x = (math.radians(lon) - store.lng_rad) * store.cos_lat
+    approx = 6371000.0 * math.hypot(dphi, x)
+    if approx > 2 * store.geofence_radius_m:
+        return approx
+    return store_distance_m(store, lat, lon)
+
 def find_store_for_location(
     lat: float,
     lon: float,
@@ -319,14 +525,11 @@ def find_store_for_location(
             "max_accuracy_m": float(max_accuracy_m),
         }
 
-    stores = db.session.execute(select(Store)).scalars().all()
+    stores = cached_stores()
     if not stores:
         return {"ok": False, "reason": "no_stores", "message": "No stores are configured."}
 
-    distances = []
-    for s in stores:
-        d = haversine_m(lat, lon, s.latitude, s.longitude)
-        distances.append((d, s))
+    distances = [(store_distance_m(s, lat, lon), s) for s in stores]
 
     distances.sort(key=lambda x: x[0])
     best_d, best_store = distances[0]
@@ -408,6 +611,8 @@ def shift_minutes(shift: "Shift") -> int:
         return 0
     return int(seconds // 60)  # whole minutes
 
+# Pure int -> str formatters, called per cell across the payroll grid/detail/exports
+@lru_cache(maxsize=4096)
 def minutes_to_human(minutes: int) -> str:
     if minutes <= 0:
         return "0 min"
@@ -420,6 +625,7 @@ def minutes_to_human(minutes: int) -> str:
     else:
         return f"{mins} min"
 
+@lru_cache(maxsize=4096)
 def minutes_to_short(minutes: int) -> str:
     if minutes <= 0:
         return "0h 00m"
@@ -427,6 +633,7 @@ def minutes_to_short(minutes: int) -> str:
     m = minutes % 60
     return f"{h}h {m:02d}m"
 
+@lru_cache(maxsize=4096)
 def minutes_to_decimal_hours(minutes: int, places: int = 4) -> str:
     if minutes <= 0:
         return "0"
@@ -464,6 +671,44 @@ def admin_guard():
         return redirect(url_for("admin_login"))
     return None
 
+def admin_list_options(*loaders):
+    """
+    Eager loaders for admin list views. In debug/testing any relationship the
+    template touches but we didn't eager-load raises instead of lazy-loading per row.
+    """
+    opts = list(loaders)
+    if app.debug or app.testing:
+        opts.append(raiseload("*"))
+    return opts
+
+# Admin list ETags: names/dropdowns aren't part of the key, so bound their staleness
+ADMIN_ETAG_BUCKET_S = 60
+
+def admin_list_etag(*parts) -> str:
+    """
+    ETag for an admin list page: URL (filters/paging) + a cheap data fingerprint.
+    """
+    raw = "|".join(str(p) for p in (request.full_path, int(time.time() // ADMIN_ETAG_BUCKET_S), *parts))
+    return hashlib.md5(raw.encode(), usedforsecurity=False).hexdigest()
+
+def admin_not_modified(etag: str):
+    """
+    304 if the browser already has this page. Never when flashes are pending,
+    since the cached copy wouldn't show them.
+    """
+    if session.get("_flashes") or etag not in request.if_none_match:
+        return None
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def admin_etag_response(body, etag: str):
+    resp = make_response(body)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
 def admin_username() -> str:
     return (session.get("admin_username") or ADMIN_USERNAME or "admin")
 
@@ -517,6 +762,34 @@ def _safe_json_dumps(obj) -> str:
     except Exception:
         return json.dumps({"_error": "json_dumps_failed"}, separators=(",", ":"))
 
+def _pretty_json(raw: str) -> str:
+    """
+    Indented form of a stored JSON string for display; returns raw as-is if it won't parse.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(orjson.loads(raw), option=orjson.OPT_INDENT_2).decode()
+        except Exception:
+            pass
+    try:
+        return json.dumps(json.loads(raw), indent=2, ensure_ascii=False)
+    except Exception:
+        return raw
+
+# Location fixes worse than this are kept with their raw payload for debugging
+BG_RAW_JSON_ACCURACY_M = 100.0
+
+def _bg_event_raw_json(payload, event_type: str, accuracy) -> str | None:
+    """
+    Normal location fixes are fully described by the structured columns,
+    so only keep the raw payload for other event types or abnormal accuracy.
+    """
+    if event_type != "location":
+        return _safe_json_dumps(payload)
+    if isinstance(accuracy, (int, float)) and accuracy > BG_RAW_JSON_ACCURACY_M:
+        return _safe_json_dumps(payload)
+    return None
+
 def _extract_location_coords(payload: dict) -> tuple[dict, dict]:
     loc = {}
     if isinstance(payload.get("location"), dict):
@@ -554,6 +827,40 @@ def _coerce_str(val, max_len: int = 120) -> str | None:
         return None
     return s[:max_len]
 
+class ClockReq(NamedTuple):
+    pin: str
+    lat: float | None
+    lon: float | None
+    accuracy_m: float | None
+    device_uuid: str | None
+    device_label: str | None
+
+def _parse_clock_req(data: dict) -> tuple[ClockReq, str | None]:
+    """
+    Shared parse/validate for the mobile punch endpoints (pin + lat/lon + optional accuracy/device).
+    Returns (req, error) where error is None, "missing_required_fields" or "invalid_location".
+    """
+    pin = (data.get("pin") or "").strip()
+    lat = data.get("lat")
+    lon = data.get("lon")
+    accuracy_m = data.get("accuracy_m")
+    device_uuid = _coerce_str(data.get("device_uuid") or data.get("uuid"))
+    device_label = _coerce_str(data.get("device_label"))
+
+    error = None
+    if not pin or lat is None or lon is None:
+        error = "missing_required_fields"
+    else:
+        try:
+            lat = float(lat)
+            lon = float(lon)
+            if accuracy_m is not None:
+                accuracy_m = float(accuracy_m)
+        except (TypeError, ValueError):
+            error = "invalid_location"
+
+    return ClockReq(pin, lat, lon, accuracy_m, device_uuid, device_label), error
+
 def _touch_employee_device(emp: "Employee", device_uuid: str | None, device_label: str | None):
     """
     Option C behavior: if device_uuid provided, overwrite employee.device_uuid.
@@ -569,6 +876,43 @@ def _touch_employee_device(emp: "Employee", device_uuid: str | None, device_labe
     except Exception:
         pass
 
+def _employee_fragment(emp: "Employee") -> dict:
+    """
+    The "employee" block returned by /api/mobile/me and /status.
+    """
+    seen = emp.device_last_seen_at
+    return {
+        "id": emp.id,
+        "name": emp.name,
+        "active": bool(emp.active),
+        "device_uuid": emp.device_uuid,
+        "device_label": emp.device_label,
+        "device_last_seen_at": fmt_dt(seen) if seen else "",
+    }
+
+def _touch_employee_device_by_id(
+    employee_id: int,
+    device_uuid: str | None,
+    device_label: str | None,
+    seen_at: datetime | None = None,
+):
+    """
+    Same as _touch_employee_device() for callers holding only an EmployeeSnapshot:
+    a single UPDATE, no ORM load. Commits with the caller's transaction.
+    Never blocks clock-ins/outs: the UPDATE runs in a SAVEPOINT so a failure
+    rolls back only the touch, not the caller's shift write.
+    """
+    if not device_uuid:
+        return
+    values = {"device_uuid": device_uuid, "device_last_seen_at": seen_at or now_utc()}
+    if device_label:
+        values["device_label"] = device_label
+    try:
+        with db.session.begin_nested():
+            db.session.execute(update(Employee).where(Employee.id == employee_id).values(**values))
+    except Exception:
+        app.logger.exception("DEVICE_TOUCH_FAILED employee_id=%s", employee_id)
+
 def _device_has_other_open_shift(device_uuid: str, employee_id: int) -> "Shift | None":
     """
     Prevent the obvious abuse: one phone can't have an open shift for Employee A
@@ -587,6 +931,185 @@ def _device_has_other_open_shift(device_uuid: str, employee_id: int) -> "Shift |
         .first()
     )
 
+def _employee_with_open_shift_counts(pin: str, device_uuid: str | None):
+    """
+    One round-trip for the clock-in guards: returns (Employee, own_open, other_open) or None.
+    own_open   = open shifts for this employee
+    other_open = open shifts on device_uuid that belong to someone else
+    """
+    own_open = (
+        select(func.count(Shift.id))
+        .where(Shift.employee_id == Employee.id, Shift.clock_out.is_(None))
+        .correlate(Employee)
+        .scalar_subquery()
+    )
+    if device_uuid:
+        other_open = (
+            select(func.count(Shift.id))
+            .where(
+                Shift.clock_out.is_(None),
+                Shift.clock_in_device_uuid == device_uuid,
+                Shift.employee_id != Employee.id
+            )
+            .correlate(Employee)
+            .scalar_subquery()
+        )
+    else:
+        other_open = literal(0)
+
+    row = db.session.execute(
+        select(Employee, own_open.label("own_open"), other_open.label("other_open"))
+        .where(Employee.pin == pin)
+        .limit(1)
+    ).first()
+    if not row:
+        return None
+    return row[0], int(row[1] or 0), int(row[2] or 0)
+
+def _open_shift_for(employee_id: int) -> "Shift | None":
+    """
+    Most recent open shift for an employee (2.0-style select; served by ix_shifts_open_by_emp).
+    """
+    return db.session.scalars(
+        select(Shift)
+        .where(Shift.employee_id == employee_id, Shift.clock_out.is_(None))
+        .order_by(Shift.clock_in.desc())
+        .limit(1)
+    ).first()
+
+def _employee_and_open_shift(pin: str) -> tuple["Employee | None", "Shift | None"]:
+    """
+    Employee by PIN plus their most recent open shift, in one SELECT (LEFT JOIN).
+    """
+    row = db.session.execute(
+        select(Employee, Shift)
+        .outerjoin(Shift, and_(Shift.employee_id == Employee.id, Shift.clock_out.is_(None)))
+        .where(Employee.pin == pin)
+        .order_by(Employee.id.asc(), Shift.clock_in.desc())
+        .limit(1)
+    ).first()
+    if not row:
+        return None, None
+    return row[0], row[1]
+
+# -----------------------------
+# Location ping writer (batched background inserts)
+# -----------------------------
+# api_ping enqueues (ping row, device touch) pairs; one daemon thread per process
+# flushes them in a single transaction per batch (executemany INSERT for the pings
+# plus one UPDATE per employee device) instead of commits per request.
+# api_ping has already answered 202, so a failed flush must not lose the batch:
+# transient DB errors are retried (then requeued), and any other error falls back
+# to row-by-row inserts so only the bad row is dropped.
+PING_FLUSH_INTERVAL_S = 1.0
+PING_FLUSH_MAX_ROWS = 200
+PING_WRITE_ATTEMPTS = 3
+PING_RETRY_BACKOFF_S = 0.5
+
+_ping_queue: "queue.Queue[tuple[dict, dict | None]]" = queue.Queue()
+_ping_writer_lock = threading.Lock()
+_ping_writer_started = False
+
+def _is_transient_db_error(e: Exception) -> bool:
+    # connection drops / server restarts / timeouts, as opposed to bad data
+    return isinstance(e, (OperationalError, InterfaceError)) or bool(getattr(e, "connection_invalidated", False))
+
+def _insert_ping_items(items: list[tuple[dict, dict | None]]):
+    rows = [row for row, _ in items]
+    # latest touch per employee wins
+    touches = {t["employee_id"]: t for _, t in items if t}
+    db.session.execute(LocationPing.__table__.insert(), rows)
+    for t in touches.values():
+        _touch_employee_device_by_id(**t)
+    db.session.commit()
+
+def _requeue_ping_items(items: list[tuple[dict, dict | None]]):
+    app.logger.warning("PING_BATCH_REQUEUED rows=%s", len(items))
+    for item in items:
+        _ping_queue.put(item)
+
+def _write_ping_rows(items: list[tuple[dict, dict | None]]):
+    if not items:
+        return
+    with app.app_context():
+        for attempt in range(PING_WRITE_ATTEMPTS):
+            if attempt:
+                time.sleep(PING_RETRY_BACKOFF_S * 2 ** (attempt - 1))
+            try:
+                _insert_ping_items(items)
+                return
+            except Exception as e:
+                db.session.rollback()
+                if not _is_transient_db_error(e):
+                    app.logger.warning("PING_BATCH_WRITE_FAILED rows=%s; retrying row by row", len(items), exc_info=True)
+                    break
+        else:
+            # DB still unreachable: keep the pings queued for a later flush
+            _requeue_ping_items(items)
+            return
+
+        # one bad row (e.g. FK to a since-deleted shift) shouldn't cost the whole batch
+        for i, item in enumerate(items):
+            try:
+                _insert_ping_items([item])
+            except Exception as e:
+                db.session.rollback()
+                if _is_transient_db_error(e):
+                    _requeue_ping_items(items[i:])
+                    return
+                row = item[0]
+                app.logger.exception(
+                    "PING_ROW_DROPPED employee_id=%s shift_id=%s",
+                    row.get("employee_id"), row.get("shift_id"),
+                )
+
+def _next_ping_batch() -> list[tuple[dict, dict | None]]:
+    items = [_ping_queue.get()]
+    deadline = time.monotonic() + PING_FLUSH_INTERVAL_S
+    while len(items) < PING_FLUSH_MAX_ROWS:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            items.append(_ping_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return items
+
+def _ping_writer_loop():
+    while True:
+        _write_ping_rows(_next_ping_batch())
+
+def _start_ping_writer():
+    # Started lazily so each gunicorn worker gets its own thread after fork
+    global _ping_writer_started
+    with _ping_writer_lock:
+        if _ping_writer_started:
+            return
+        threading.Thread(target=_ping_writer_loop, name="ping-writer", daemon=True).start()
+        _ping_writer_started = True
+
+def enqueue_location_ping(row: dict, device_touch: dict | None = None):
+    """
+    device_touch: kwargs for _touch_employee_device_by_id(), written in the same batch.
+    """
+    if not _ping_writer_started:
+        _start_ping_writer()
+    _ping_queue.put((row, device_touch))
+
+@atexit.register
+def _flush_ping_queue():
+    items = []
+    while True:
+        try:
+            items.append(_ping_queue.get_nowait())
+        except queue.Empty:
+            break
+    _write_ping_rows(items)
+    # anything requeued here has no later flush to go to
+    if not _ping_queue.empty():
+        app.logger.error("PING_QUEUE_LOST_AT_EXIT rows=%s", _ping_queue.qsize())
+
 # Make helpers available in templates
 @app.context_processor
 def inject_helpers():
@@ -643,6 +1166,171 @@ def _ensure_column(table_name: str, column_name: str, sql_type: str):
             return
         app.logger.exception("Could not ensure column %s.%s", table_name, column_name)
 
+def _ensure_nullable(table_name: str, column_name: str):
+    """
+    Best-effort: drop a NOT NULL constraint created by an older create_all().
+    Checks first (like _ensure_column) so boot doesn't take a table lock when
+    there's nothing to do. SQLite can't ALTER COLUMN, so the table is rebuilt.
+    """
+    try:
+        dialect = db.engine.dialect.name
+
+        if dialect == "postgresql":
+            row = db.session.execute(text("""
+                SELECT is_nullable
+                FROM information_schema.columns
+                WHERE table_name = :t AND column_name = :c
+                LIMIT 1
+            """), {"t": table_name, "c": column_name}).first()
+            if not row or row[0] == "YES":
+                return
+            db.session.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column_name} DROP NOT NULL"))
+            db.session.commit()
+
+        elif dialect == "sqlite":
+            rows = db.session.execute(text(f"PRAGMA table_info({table_name})")).fetchall()
+            col = next((r for r in rows if r[1] == column_name), None)
+            if not col or not col[3]:  # r[3] = notnull
+                return
+            _rebuild_sqlite_table_nullable(table_name, column_name)
+
+        else:
+            return
+
+        app.logger.info("Dropped NOT NULL on %s.%s", table_name, column_name)
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Could not drop NOT NULL on %s.%s", table_name, column_name)
+
+def _rebuild_sqlite_table_nullable(table_name: str, column_name: str):
+    """
+    SQLite's documented table rebuild: copy into a new table whose CREATE sql has
+    the column's NOT NULL removed, swap names, then recreate the table's indexes.
+    """
+    table_sql = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :t"), {"t": table_name}
+    ).scalar_one()
+    index_sqls = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :t AND sql IS NOT NULL"),
+        {"t": table_name},
+    ).scalars().all()
+
+    new_table = f"{table_name}__rebuild"
+    new_sql = re.sub(rf'((?<!\w)"?{column_name}"?\s[^,]*?)\s+NOT NULL', r"\1", table_sql, count=1)
+    new_sql = re.sub(rf'^CREATE TABLE\s+"?{table_name}"?', f"CREATE TABLE {new_table}", new_sql, count=1)
+
+    db.session.execute(text(f"DROP TABLE IF EXISTS {new_table}"))
+    db.session.execute(text(new_sql))
+    db.session.execute(text(f"INSERT INTO {new_table} SELECT * FROM {table_name}"))
+    db.session.execute(text(f"DROP TABLE {table_name}"))
+    db.session.execute(text(f"ALTER TABLE {new_table} RENAME TO {table_name}"))
+    for sql in index_sqls:
+        db.session.execute(text(sql))
+    db.session.commit()
+
+def _normalize_store_tokens():
+    """
+    Best-effort: lowercase any legacy mixed-case store codes so lookups can be a
+    plain equality on the unique qr_token index (no func.lower needed).
+    """
+    try:
+        res = db.session.execute(text(
+            "UPDATE stores SET qr_token = lower(qr_token) WHERE qr_token <> lower(qr_token)"
+        ))
+        db.session.commit()
+        if res.rowcount:
+            app.logger.info("Normalized %s store code(s) to lowercase", res.rowcount)
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Could not normalize store codes (case-duplicate codes?)")
+
+def _ensure_index(index_name: str, table_name: str, columns_sql: str, where_sql: str = "", include_sql: str = ""):
+    """
+    Best-effort: CREATE INDEX IF NOT EXISTS (SQLite + Postgres).
+    Postgres builds CONCURRENTLY (outside a transaction) so a large location_pings
+    table doesn't block ping writes while the index builds. A CONCURRENTLY build that
+    was killed part-way leaves an INVALID index that IF NOT EXISTS would skip forever,
+    so an invalid one is dropped and rebuilt.
+    include_sql (covering columns) is Postgres-only; SQLite gets the plain index.
+    """
+    where = f" WHERE {where_sql}" if where_sql else ""
+    try:
+        if db.engine.dialect.name == "postgresql":
+            include = f" INCLUDE ({include_sql})" if include_sql else ""
+            ddl = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table_name} ({columns_sql}){include}{where}"
+            with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                valid = conn.execute(text("""
+                    SELECT i.indisvalid
+                    FROM pg_index i
+                    JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = :n
+                """), {"n": index_name}).scalar()
+                if valid:
+                    return
+                if valid is False:
+                    app.logger.warning("Rebuilding invalid index %s", index_name)
+                    conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+                conn.execute(text(ddl))
+            app.logger.info("Built index %s", index_name)
+        else:
+            ddl = f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns_sql}){where}"
+            db.session.execute(text(ddl))
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        msg = str(e).lower()
+        if "already exists" in msg or "duplicate" in msg:
+            app.logger.info("Index already exists (race): %s", index_name)
+            return
+        app.logger.exception("Could not ensure index %s", index_name)
+
+def _normalize_event_types():
+    """
+    Best-effort: lowercase legacy mobile_events.event_type values so the admin
+    filter can be a plain (indexable) equality.
+    """
+    try:
+        res = db.session.execute(text(
+            "UPDATE mobile_events SET event_type = lower(event_type) WHERE event_type <> lower(event_type)"
+        ))
+        db.session.commit()
+        if res.rowcount:
+            app.logger.info("Normalized %s mobile event type(s) to lowercase", res.rowcount)
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Could not normalize mobile event types")
+
+def run_schema_maintenance():
+    """
+    One-off schema/data maintenance: index builds and legacy-value cleanups.
+    On Postgres run it once per deploy via `python migrate_db.py` (release /
+    pre-deploy command) rather than at import, where every gunicorn worker would
+    race the same CONCURRENTLY builds and a worker timeout can kill one mid-build.
+    Safe to re-run: every step checks before it changes anything.
+    """
+    # Store codes are stored canonical (lowercase); only rows that still need it are touched
+    _normalize_store_tokens()
+
+    # Indexes for admin_pings filters/order and the open-shift lookup
+    _ensure_index("ix_location_pings_created_at", "location_pings", "created_at DESC")
+    _ensure_index("ix_location_pings_emp_created", "location_pings", "employee_id, created_at DESC")
+    _ensure_index("ix_location_pings_store_created", "location_pings", "store_id, created_at DESC")
+    _ensure_index("ix_shifts_open_by_emp", "shifts", "employee_id", "clock_out IS NULL")
+    _ensure_index("ix_shifts_clock_in", "shifts", "clock_in DESC")
+    _ensure_index("ix_employees_pin", "employees", "pin")
+
+    # Payroll: closed shifts by clock_out range (index-only scan); audit log newest-first
+    _ensure_index(
+        "ix_shifts_clock_out_closed", "shifts", "clock_out",
+        where_sql="clock_out IS NOT NULL",
+        include_sql="employee_id, store_id, clock_in",
+    )
+    _ensure_index("ix_shift_edit_audit_created_at", "shift_edit_audit", "created_at DESC")
+
+    # Mobile event viewer filters by type and orders by received_at
+    _normalize_event_types()
+    _ensure_index("ix_mobile_events_type_received", "mobile_events", "event_type, received_at DESC")
+
 # -----------------------------
 # Create tables on startup (Option B)
 # -----------------------------
@@ -661,6 +1349,16 @@ with app.app_context():
     _ensure_column("shifts", "clock_in_device_uuid", "VARCHAR(120)")
     _ensure_column("shifts", "clock_out_device_uuid", "VARCHAR(120)")
 
+    _ensure_column("mobile_issue_reports", "payload_pretty", "TEXT")
+
+    # raw_json is now only stored for anomalies
+    _ensure_nullable("mobile_events", "raw_json")
+
+    # Local SQLite (single process): run the one-off maintenance inline.
+    # Postgres runs it from migrate_db.py instead, not from every worker boot.
+    if db.engine.dialect.name == "sqlite":
+        run_schema_maintenance()
+
 # -----------------------------
 # Fingerprint (DEBUG)
 # -----------------------------
@@ -768,7 +1466,7 @@ def dev_import_stores():
         except (TypeError, ValueError):
             continue
 
-        existing = Store.query.filter(func.lower(Store.qr_token) == qr_token).first()
+        existing = Store.query.filter(Store.qr_token == qr_token).first()
         if existing:
             existing.name = name
             existing.latitude = lat
@@ -786,6 +1484,7 @@ def dev_import_stores():
         upserted += 1
 
     db.session.commit()
+    invalidate_store_cache()
     return jsonify({"ok": True, "imported_or_updated": upserted})
 
 @app.post("/dev/import-employees")
@@ -823,6 +1522,7 @@ def dev_import_employees():
         upserted += 1
 
     db.session.commit()
+    invalidate_employee_cache()
     return jsonify({"ok": True, "imported_or_updated": upserted})
 
 @app.post("/dev/add-store")
@@ -850,7 +1550,7 @@ def dev_add_store():
     except (TypeError, ValueError):
         return jsonify({"ok": False, "error": "invalid_values"}), 400
 
-    store = Store.query.filter(func.lower(Store.qr_token) == qr_token).first()
+    store = Store.query.filter(Store.qr_token == qr_token).first()
     if store:
         store.name = name
         store.latitude = lat
@@ -867,6 +1567,7 @@ def dev_add_store():
         db.session.add(store)
 
     db.session.commit()
+    invalidate_store_cache()
     return jsonify({"ok": True, "store_id": store.id, "name": store.name})
 
 # -----------------------------
@@ -887,7 +1588,7 @@ def api_stores_suggest():
     matches = (
         Store.query
         .filter(
-            (func.lower(Store.qr_token).like(f"%{ql}%")) |
+            (Store.qr_token.like(f"%{ql}%")) |
             (func.lower(Store.name).like(f"%{ql}%"))
         )
         .order_by(Store.name.asc())
@@ -937,15 +1638,8 @@ def api_mobile_me():
 
     return jsonify({
         "ok": True,
-        "employee": {
-            "id": emp.id,
-            "name": emp.name,
-            "active": bool(emp.active),
-            "device_uuid": emp.device_uuid,
-            "device_label": emp.device_label,
-            "device_last_seen_at": fmt_dt(emp.device_last_seen_at) if emp.device_last_seen_at else ""
-        },
-        "server_time_utc": now_utc().isoformat() + "Z"
+        "employee": _employee_fragment(emp),
+        "server_time_utc": now_utc()
     })
 
 @app.post("/api/mobile/status")
@@ -982,25 +1676,18 @@ def api_mobile_status():
 
     payload = {
         "ok": True,
-        "employee": {
-            "id": emp.id,
-            "name": emp.name,
-            "active": bool(emp.active),
-            "device_uuid": emp.device_uuid,
-            "device_label": emp.device_label,
-            "device_last_seen_at": fmt_dt(emp.device_last_seen_at) if emp.device_last_seen_at else "",
-        },
-        "server_time_utc": now_utc().isoformat() + "Z",
+        "employee": _employee_fragment(emp),
+        "server_time_utc": now_utc(),
         "open_shift": None,
     }
 
     if open_shift:
-        store = Store.query.get(open_shift.store_id)
+        store = store_by_id(open_shift.store_id)
         payload["open_shift"] = {
             "shift_id": open_shift.id,
             "store_id": open_shift.store_id,
             "store_name": store.name if store else "",
-            "clock_in_utc": open_shift.clock_in.isoformat() + "Z",
+            "clock_in_utc": open_shift.clock_in,
             "clock_in_local": fmt_dt(open_shift.clock_in),
             "closed_by_admin": bool(open_shift.closed_by_admin),
         }
@@ -1017,52 +1704,38 @@ def api_mobile_clock_in():
 
     data = request.get_json(silent=True) or {}
 
-    pin = (data.get("pin") or "").strip()
+    req, req_err = _parse_clock_req(data)
     qr_token = normalize_store_code(
         data.get("qr_token") or data.get("store_code") or ""
     )
 
-    lat = data.get("lat")
-    lon = data.get("lon")
-    accuracy_m = data.get("accuracy_m")
-    device_uuid = _coerce_str(data.get("device_uuid") or data.get("uuid"))
-    device_label = _coerce_str(data.get("device_label"))
-
-    if not pin or not qr_token or lat is None or lon is None:
+    if not qr_token or req_err == "missing_required_fields":
         return jsonify({
             "ok": False,
             "error": "missing_required_fields",
             "required": ["pin", "qr_token", "lat", "lon"]
         }), 400
 
-    try:
-        lat = float(lat)
-        lon = float(lon)
-        if accuracy_m is not None:
-            accuracy_m = float(accuracy_m)
-    except (TypeError, ValueError):
-        return jsonify({"ok": False, "error": "invalid_location"}), 400
+    if req_err:
+        return jsonify({"ok": False, "error": req_err}), 400
 
-    emp = Employee.query.filter_by(pin=pin).first()
+    pin, lat, lon, accuracy_m, device_uuid, device_label = req
+
+    guard_row = _employee_with_open_shift_counts(pin, device_uuid)
+    emp = guard_row[0] if guard_row else None
     if not emp or not emp.active:
         return jsonify({"ok": False, "error": "invalid_or_inactive_employee"}), 403
+    _, own_open, other_open = guard_row
 
-    selected_store = Store.query.filter(func.lower(Store.qr_token) == qr_token).first()
+    selected_store = store_by_token(qr_token)
     if not selected_store:
         return jsonify({"ok": False, "error": "invalid_store_code"}), 404
 
-    existing = Shift.query.filter(
-        Shift.employee_id == emp.id,
-        Shift.clock_out.is_(None)
-    ).first()
-
-    if existing:
+    if own_open:
         return jsonify({"ok": False, "error": "already_clocked_in"}), 409
 
-    if device_uuid:
-        other = _device_has_other_open_shift(device_uuid, emp.id)
-        if other:
-            return jsonify({"ok": False, "error": "device_in_use"}), 409
+    if other_open:
+        return jsonify({"ok": False, "error": "device_in_use"}), 409
 
     if accuracy_m is not None and accuracy_m > 120:
         return jsonify({
@@ -1072,12 +1745,7 @@ def api_mobile_clock_in():
             "accuracy_m": accuracy_m
         }), 403
 
-    dist_m = haversine_m(
-        lat,
-        lon,
-        selected_store.latitude,
-        selected_store.longitude
-    )
+    dist_m = store_distance_m(selected_store, lat, lon)
 
     if dist_m > selected_store.geofence_radius_m:
         return jsonify({
@@ -1111,7 +1779,7 @@ def api_mobile_clock_in():
         "store_id": selected_store.id,
         "store_name": selected_store.name,
         "distance_m": round(dist_m, 1),
-        "clock_in_utc": shift.clock_in.isoformat() + "Z"
+        "clock_in_utc": shift.clock_in
     }), 200
 
 @app.post("/api/mobile/clock-out")
@@ -1123,25 +1791,13 @@ def api_mobile_clock_out():
 
     data = request.get_json(silent=True) or {}
 
-    pin = (data.get("pin") or "").strip()
-    lat = data.get("lat")
-    lon = data.get("lon")
-    accuracy_m = data.get("accuracy_m")
-    device_uuid = _coerce_str(data.get("device_uuid") or data.get("uuid"))
-    device_label = _coerce_str(data.get("device_label"))
-
-    if not pin or lat is None or lon is None:
-        return jsonify({"ok": False, "error": "missing_required_fields"}), 400
+    req, req_err = _parse_clock_req(data)
+    if req_err:
+        return jsonify({"ok": False, "error": req_err}), 400
 
-    try:
-        lat = float(lat)
-        lon = float(lon)
-        if accuracy_m is not None:
-            accuracy_m = float(accuracy_m)
-    except (TypeError, ValueError):
-        return jsonify({"ok": False, "error": "invalid_location"}), 400
+    pin, lat, lon, accuracy_m, device_uuid, device_label = req
 
-    emp = Employee.query.filter_by(pin=pin).first()
+    emp = employee_by_pin(pin)
     if not emp or not emp.active:
         return jsonify({"ok": False, "error": "invalid_or_inactive_employee"}), 403
 
@@ -1155,7 +1811,7 @@ def api_mobile_clock_out():
     if not open_shift:
         return jsonify({"ok": False, "error": "no_open_shift"}), 409
 
-    store = Store.query.get(open_shift.store_id)
+    store = store_by_id(open_shift.store_id)
 
     result = find_store_for_location(lat, lon, accuracy_m)
     if not result.get("ok"):
@@ -1164,7 +1820,7 @@ def api_mobile_clock_out():
     if store and result.get("store").id != store.id:
         return jsonify({"ok": False, "error": "wrong_store_location"}), 403
 
-    _touch_employee_device(emp, device_uuid, device_label)
+    _touch_employee_device_by_id(emp.id, device_uuid, device_label)
 
     open_shift.clock_out = now_utc()
     open_shift.clock_out_lat = lat
@@ -1172,13 +1828,14 @@ def api_mobile_clock_out():
     open_shift.clock_out_device_uuid = device_uuid
 
     db.session.commit()
+    invalidate_payroll_cache()
 
     minutes = shift_minutes(open_shift)
 
     return jsonify({
         "ok": True,
         "shift_id": open_shift.id,
-        "clock_out_utc": open_shift.clock_out.isoformat() + "Z",
+        "clock_out_utc": open_shift.clock_out,
         "minutes": minutes,
         "human": minutes_to_human(minutes)
     })
@@ -1192,47 +1849,29 @@ def api_mobile_auto_exit_close():
 
     data = request.get_json(silent=True) or {}
 
-    pin = (data.get("pin") or "").strip()
-    lat = data.get("lat")
-    lon = data.get("lon")
-    accuracy_m = data.get("accuracy_m")
-    device_uuid = _coerce_str(data.get("device_uuid") or data.get("uuid"))
-    device_label = _coerce_str(data.get("device_label"))
-
     # optional: reason from app
     reason = (data.get("reason") or "Auto-close after EXIT").strip()
 
-    if not pin or lat is None or lon is None:
-        return jsonify({"ok": False, "error": "missing_required_fields"}), 400
+    req, req_err = _parse_clock_req(data)
+    if req_err:
+        return jsonify({"ok": False, "error": req_err}), 400
 
-    try:
-        lat = float(lat)
-        lon = float(lon)
-        if accuracy_m is not None:
-            accuracy_m = float(accuracy_m)
-    except (TypeError, ValueError):
-        return jsonify({"ok": False, "error": "invalid_location"}), 400
+    pin, lat, lon, accuracy_m, device_uuid, device_label = req
 
-    emp = Employee.query.filter_by(pin=pin).first()
+    emp, open_shift = _employee_and_open_shift(pin)
     if not emp or not emp.active:
         return jsonify({"ok": False, "error": "invalid_or_inactive_employee"}), 403
 
     # Open shift required
-    open_shift = (
-        Shift.query
-        .filter(Shift.employee_id == emp.id, Shift.clock_out.is_(None))
-        .order_by(Shift.clock_in.desc())
-        .first()
-    )
     if not open_shift:
         return jsonify({"ok": True, "already_closed": True, "message": "No open shift."}), 200
 
-    store = Store.query.get(open_shift.store_id)
+    store = store_by_id(open_shift.store_id)
     if not store:
         return jsonify({"ok": False, "error": "store_not_found"}), 500
 
     # Distance check
-    dist_m = haversine_m(lat, lon, store.latitude, store.longitude)
+    dist_m = store_distance_m(store, lat, lon)
 
     # Accuracy gate (prevent bad GPS closing someone incorrectly)
     # Match your validate-location gate style
@@ -1272,7 +1911,8 @@ def api_mobile_auto_exit_close():
     open_shift.admin_closed_at = now_utc()
     open_shift.admin_close_reason = reason
 
-    audit = ShiftEditAudit(
+    # Write-only audit row: Core insert, same transaction as the shift update
+    db.session.execute(ShiftEditAudit.__table__.insert().values(
         shift_id=open_shift.id,
         action="auto_exit_close",
         editor="AUTO_EXIT",
@@ -1280,10 +1920,11 @@ def api_mobile_auto_exit_close():
         old_clock_in=old_in,
         old_clock_out=old_out,
         new_clock_in=open_shift.clock_in,
-        new_clock_out=open_shift.clock_out
-    )
-    db.session.add(audit)
+        new_clock_out=open_shift.clock_out,
+        created_at=now_utc()
+    ))
     db.session.commit()
+    invalidate_payroll_cache()
 
     log_event(
         "AUTO_EXIT_CLOSE_OK",
@@ -1305,7 +1946,7 @@ def api_mobile_auto_exit_close():
         "dist_m": round(dist_m, 1),
         "minutes": mins,
         "human": minutes_to_human(mins),
-        "clock_out_utc": open_shift.clock_out.isoformat() + "Z",
+        "clock_out_utc": open_shift.clock_out,
         "message": "Shift auto-closed after EXIT."
     }), 200
 
@@ -1335,7 +1976,7 @@ def api_mobile_geofences():
     if not emp or not emp.active:
         return jsonify({"ok": False, "error": "invalid_or_inactive_employee"}), 403
 
-    store = Store.query.filter(func.lower(Store.qr_token) == qr_token).first()
+    store = store_by_token(qr_token)
     if not store:
         return jsonify({"ok": False, "error": "invalid_store_code"}), 404
 
@@ -1402,7 +2043,7 @@ def api_mobile_bg_event():
             accuracy=float(accuracy) if isinstance(accuracy, (int, float)) else None,
             event_at=event_at,
             received_at=now_utc(),
-            raw_json=_safe_json_dumps(payload),
+            raw_json=_bg_event_raw_json(payload, event_type, accuracy),
         )
         db.session.add(evt)
         db.session.commit()
@@ -1442,7 +2083,7 @@ def api_mobile_report_issue():
         store_obj = payload.get("store") if isinstance(payload.get("store"), dict) else {}
         store_code = normalize_store_code(store_obj.get("code") or "")
         if store_code:
-            s = Store.query.filter(func.lower(Store.qr_token) == store_code).first()
+            s = store_by_token(store_code)
             if s:
                 store_id = s.id
     except Exception:
@@ -1463,12 +2104,14 @@ def api_mobile_report_issue():
         pass
 
     try:
+        payload_json = _safe_json_dumps(payload)
         report = MobileIssueReport(
             employee_id=emp.id,
             store_id=store_id,
             shift_id=shift_id,
             message=msg,
-            payload_json=_safe_json_dumps(payload),
+            payload_json=payload_json,
+            payload_pretty=_pretty_json(payload_json),
             status="open",
             created_at=now_utc(),
         )
@@ -1506,39 +2149,51 @@ def api_mobile_bg_locations_bulk():
     if device_uuid is not None:
         device_uuid = str(device_uuid)
 
-    saved = 0
-    try:
-        for item in locations:
-            if not isinstance(item, dict):
-                continue
+    # Plain row dicts + one Core executemany INSERT (no per-item ORM objects)
+    received_at = now_utc()
+    rows = []
+    for item in locations:
+        if not isinstance(item, dict):
+            continue
 
-            coords = item.get("coords") if isinstance(item.get("coords"), dict) else {}
-            ts_ms = item.get("timestamp")
-            event_at = None
-            if isinstance(ts_ms, (int, float)) and ts_ms > 0:
-                try:
-                    event_at = datetime.utcfromtimestamp(ts_ms / 1000.0)
-                except Exception:
-                    event_at = None
-
-            evt = MobileEvent(
-                event_type="location",
-                device_uuid=str(item.get("uuid") or device_uuid) if (item.get("uuid") or device_uuid) else None,
-                is_moving=bool(item.get("is_moving")) if isinstance(item.get("is_moving"), bool) else None,
-                lat=float(coords.get("latitude")) if isinstance(coords.get("latitude"), (int, float)) else None,
-                lng=float(coords.get("longitude")) if isinstance(coords.get("longitude"), (int, float)) else None,
-                accuracy=float(coords.get("accuracy")) if isinstance(coords.get("accuracy"), (int, float)) else None,
-                event_at=event_at,
-                received_at=now_utc(),
-                raw_json=_safe_json_dumps(item),
-            )
-            db.session.add(evt)
-            saved += 1
+        coords = item.get("coords")
+        if not isinstance(coords, dict):
+            coords = {}
+        lat = coords.get("latitude")
+        lng = coords.get("longitude")
+        accuracy = coords.get("accuracy")
+        is_moving = item.get("is_moving")
+        item_uuid = item.get("uuid") or device_uuid
+
+        ts_ms = item.get("timestamp")
+        event_at = None
+        if isinstance(ts_ms, (int, float)) and ts_ms > 0:
+            try:
+                event_at = datetime.utcfromtimestamp(ts_ms / 1000.0)
+            except Exception:
+                event_at = None
 
-        db.session.commit()
-    except Exception:
-        app.logger.exception("MOBILE_BG_LOCATIONS_SAVE_FAILED")
-        return jsonify({"ok": False, "error": "db_error"}), 500
+        rows.append({
+            "event_type": "location",
+            "device_uuid": str(item_uuid) if item_uuid else None,
+            "is_moving": is_moving if isinstance(is_moving, bool) else None,
+            "lat": float(lat) if isinstance(lat, (int, float)) else None,
+            "lng": float(lng) if isinstance(lng, (int, float)) else None,
+            "accuracy": float(accuracy) if isinstance(accuracy, (int, float)) else None,
+            "event_at": event_at,
+            "received_at": received_at,
+            "raw_json": None,
+        })
+
+    saved = len(rows)
+    if rows:
+        try:
+            db.session.execute(MobileEvent.__table__.insert(), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("MOBILE_BG_LOCATIONS_SAVE_FAILED")
+            return jsonify({"ok": False, "error": "db_error"}), 500
 
     return jsonify({"ok": True, "saved": saved})
 
@@ -1626,6 +2281,7 @@ def mobile_clock_in():
 
     open_shift = Shift.query.filter_by(employee_id=employee.id, clock_out=None).order_by(Shift.clock_in.desc()).first()
     if open_shift:
+        open_store = store_by_id(open_shift.store_id)
         return jsonify({
             "ok": True,
             "already_clocked_in": True,
@@ -1633,7 +2289,7 @@ def mobile_clock_in():
             "employee_id": employee.id,
             "employee_name": employee.name,
             "store_id": open_shift.store_id,
-            "store_name": Store.query.get(open_shift.store_id).name if open_shift.store_id else None,
+            "store_name": open_store.name if open_store else None,
             "clock_in": open_shift.clock_in.isoformat(),
         }), 200
 
@@ -1694,7 +2350,7 @@ def api_clockin():
     if not emp or not emp.active:
         return jsonify({"error": "Invalid or inactive employee."}), 403
 
-    store = Store.query.filter(func.lower(Store.qr_token) == qr_token).first()
+    store = store_by_token(qr_token)
     if not store:
         log_event("CLOCKIN_DENY_INVALID_STORE", employee_pin=pin, store_code=qr_token)
         return jsonify({"error": "Invalid store code."}), 404
@@ -1727,7 +2383,7 @@ def api_clockin():
         log_event("CLOCKIN_DENY_BAD_LATLNG", employee_id=emp.id, store_id=store.id)
         return jsonify({"error": "Invalid lat/lng."}), 400
 
-    dist_m = haversine_m(lat, lng, store.latitude, store.longitude)
+    dist_m = store_distance_m(store, lat, lng)
 
     log_event(
         "CLOCKIN_ATTEMPT",
@@ -1792,11 +2448,11 @@ def api_clockout():
     if not pin:
         return jsonify({"error": "Missing PIN."}), 400
 
-    emp = Employee.query.filter_by(pin=pin).first()
+    emp = employee_by_pin(pin)
     if not emp or not emp.active:
         return jsonify({"error": "Invalid or inactive employee."}), 403
 
-    open_shift = Shift.query.filter_by(employee_id=emp.id, clock_out=None).order_by(Shift.clock_in.desc()).first()
+    open_shift = _open_shift_for(emp.id)
     if not open_shift:
         log_event("CLOCKOUT_DENY_NO_OPEN_SHIFT", employee_id=emp.id)
         return jsonify({"error": "No open shift found. You must clock in first."}), 409
@@ -1812,8 +2468,8 @@ def api_clockout():
         log_event("CLOCKOUT_DENY_BAD_LATLNG", employee_id=emp.id, shift_id=open_shift.id)
         return jsonify({"error": "Invalid lat/lng."}), 400
 
-    store = Store.query.get(open_shift.store_id)
-    dist_m = haversine_m(lat, lng, store.latitude, store.longitude)
+    store = store_by_id(open_shift.store_id)
+    dist_m = geofence_distance_m(store, lat, lng)
 
     log_event(
         "CLOCKOUT_ATTEMPT",
@@ -1840,13 +2496,14 @@ def api_clockout():
         )
         return jsonify({"error": "You are not at the store location."}), 403
 
-    _touch_employee_device(emp, device_uuid, device_label)
+    _touch_employee_device_by_id(emp.id, device_uuid, device_label)
 
     open_shift.clock_out = now_utc()
     open_shift.clock_out_lat = lat
     open_shift.clock_out_lng = lng
     open_shift.clock_out_device_uuid = device_uuid
     db.session.commit()
+    invalidate_payroll_cache()
 
     mins = shift_minutes(open_shift)
     log_event("CLOCKOUT_OK", employee_id=emp.id, shift_id=open_shift.id, minutes=mins, device_uuid=device_uuid or "")
@@ -1876,11 +2533,17 @@ def api_ping():
     if not pin:
         return jsonify({"error": "Missing PIN."}), 400
 
-    emp = Employee.query.filter_by(pin=pin).first()
+    emp = employee_by_pin(pin)
     if not emp or not emp.active:
         return jsonify({"error": "Invalid or inactive employee."}), 403
 
-    open_shift = Shift.query.filter_by(employee_id=emp.id, clock_out=None).order_by(Shift.clock_in.desc()).first()
+    # The ping path only needs the shift id and its store
+    open_shift = db.session.execute(
+        select(Shift.id, Shift.store_id)
+        .where(Shift.employee_id == emp.id, Shift.clock_out.is_(None))
+        .order_by(Shift.clock_in.desc())
+        .limit(1)
+    ).first()
     if not open_shift:
         return jsonify({"error": "No open shift."}), 409
 
@@ -1893,24 +2556,30 @@ def api_ping():
     except ValueError:
         return jsonify({"error": "Invalid lat/lng."}), 400
 
-    store = Store.query.get(open_shift.store_id)
-    dist_m = haversine_m(lat, lng, store.latitude, store.longitude)
+    store = store_by_id(open_shift.store_id)
+    dist_m = geofence_distance_m(store, lat, lng)
     inside = dist_m <= store.geofence_radius_m
 
-    _touch_employee_device(emp, device_uuid, device_label)
-
-    ping = LocationPing(
-        employee_id=emp.id,
-        shift_id=open_shift.id,
-        store_id=store.id,
-        lat=lat,
-        lng=lng,
-        dist_m=float(dist_m),
-        inside_radius=bool(inside),
-        created_at=now_utc()
-    )
-    db.session.add(ping)
-    db.session.commit()
+    # Ping insert and device last-seen update go out together in the writer's batch transaction
+    ping_at = now_utc()
+    device_touch = None
+    if device_uuid:
+        device_touch = {
+            "employee_id": emp.id,
+            "device_uuid": device_uuid,
+            "device_label": device_label,
+            "seen_at": ping_at,
+        }
+    enqueue_location_ping({
+        "employee_id": emp.id,
+        "shift_id": open_shift.id,
+        "store_id": store.id,
+        "lat": lat,
+        "lng": lng,
+        "dist_m": float(dist_m),
+        "inside_radius": bool(inside),
+        "created_at": ping_at,
+    }, device_touch)
 
     log_event(
         "PING_OK",
@@ -1924,11 +2593,12 @@ def api_ping():
 
     return jsonify({
         "ok": True,
+        "queued": True,
         "shift_id": open_shift.id,
         "dist_m": round(dist_m, 1),
         "inside_radius": inside,
-        "ping_at": fmt_dt(ping.created_at),
-    })
+        "ping_at": fmt_dt(ping_at),
+    }), 202
 
 # -----------------------------
 # Admin Auth
@@ -1959,19 +2629,36 @@ def admin_logout():
 # Admin Pages
 # -----------------------------
 
+# "System Stats" counters change slowly: one SELECT, cached briefly per process
+DASHBOARD_STATS_TTL_S = 60.0
+_dashboard_stats_cache: tuple[float, dict] | None = None
+
+def dashboard_stats() -> dict:
+    global _dashboard_stats_cache
+    if _dashboard_stats_cache and (time.monotonic() - _dashboard_stats_cache[0]) < DASHBOARD_STATS_TTL_S:
+        return _dashboard_stats_cache[1]
+
+    last7 = now_utc() - timedelta(days=7)
+    row = db.session.execute(select(
+        select(func.count(Employee.id)).scalar_subquery().label("total_employees"),
+        select(func.count(Employee.id)).where(Employee.active.is_(True)).scalar_subquery().label("active_employees"),
+        select(func.count(Employee.id)).where(Employee.active.is_(False)).scalar_subquery().label("inactive_employees"),
+        select(func.count(Store.id)).scalar_subquery().label("stores"),
+        select(func.count(Shift.id)).where(Shift.clock_in >= last7).scalar_subquery().label("shifts_7d"),
+    )).one()
+
+    stats = dict(row._mapping)
+    stats["stats_as_of"] = now_utc()
+    _dashboard_stats_cache = (time.monotonic(), stats)
+    return stats
+
 @app.get("/admin")
 def admin_dashboard():
     guard = admin_guard()
     if guard:
         return guard
 
-    total_employees = Employee.query.count()
-    active_employees = Employee.query.filter_by(active=True).count()
-    inactive_employees = Employee.query.filter_by(active=False).count()
-    stores = Store.query.count()
-
-    last7 = now_utc() - timedelta(days=7)
-    shifts_7d = Shift.query.filter(Shift.clock_in >= last7).count()
+    stats = dashboard_stats()
 
     # -----------------------------
     # Open shifts
@@ -2064,11 +2751,7 @@ def admin_dashboard():
 
     return render_template(
         "admin.html",
-        total_employees=total_employees,
-        active_employees=active_employees,
-        inactive_employees=inactive_employees,
-        stores=stores,
-        shifts_7d=shifts_7d,
+        **stats,
         open_shift_count=open_shift_count,
         open_shift_rows=open_shift_rows,
         longest_open_shift_rows=longest_open_shift_rows,
@@ -2095,22 +2778,32 @@ def admin_issues():
         limit = 200
     limit = max(25, min(limit, 500))
 
-    q = MobileIssueReport.query
-
-    if status in ("open", "resolved", "ignored"):
-        q = q.filter(MobileIssueReport.status == status)
-    else:
+    if status not in ("open", "resolved", "ignored"):
         status = "open"
-        q = q.filter(MobileIssueReport.status == status)
+
+    # status changes move rows between lists, so fingerprint the set (count + id sum)
+    fp = db.session.execute(
+        select(func.count(), func.sum(MobileIssueReport.id), func.max(MobileIssueReport.resolved_at))
+        .where(MobileIssueReport.status == status)
+    ).one()
+    etag = admin_list_etag(*fp)
+    not_modified = admin_not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    q = MobileIssueReport.query.options(*admin_list_options(
+        selectinload(MobileIssueReport.employee),
+        selectinload(MobileIssueReport.store),
+    )).filter(MobileIssueReport.status == status)
 
     issues = q.order_by(MobileIssueReport.created_at.desc()).limit(limit).all()
 
-    return render_template(
+    return admin_etag_response(render_template(
         "admin_issues.html",
         issues=issues,
         status=status,
         limit=limit,
-    )
+    ), etag)
 
 @app.post("/admin/issues/<int:issue_id>/set-status")
 def admin_issue_set_status(issue_id: int):
@@ -2183,6 +2876,17 @@ def admin_issue_toggle(issue_id: int):
 
     return redirect(url_for("admin_issues", status=status or None, q=q or None, page=page or None))
 
+_INT_RE = re.compile(r"[0-9]+")
+
+# Lowercased query/CSV flag values -> bool (anything else = not given)
+_BOOL_MAP = (
+    {v: True for v in ("1", "true", "yes", "y", "inside")}
+    | {v: False for v in ("0", "false", "no", "n", "outside")}
+)
+
+# Results header shows "10000+" past this instead of an exact total
+PINGS_COUNT_CAP = 10000
+
 # ✅ Admin GPS Ping Viewer
 @app.get("/admin/pings")
 def admin_pings():
@@ -2233,53 +2937,81 @@ def admin_pings():
         start_str = (today_local - timedelta(days=7)).isoformat()
         end_str = today_local.isoformat()
 
-    q = (
-        LocationPing.query
-        .filter(LocationPing.created_at >= q_start, LocationPing.created_at <= q_end)
-        .order_by(LocationPing.created_at.desc())
-    )
-
-    if employee_id:
-        try:
-            q = q.filter(LocationPing.employee_id == int(employee_id))
-        except ValueError:
-            flash("employee_id must be a number.", "error")
-
-    if store_id:
-        try:
-            q = q.filter(LocationPing.store_id == int(store_id))
-        except ValueError:
-            flash("store_id must be a number.", "error")
+    conds = [LocationPing.created_at >= q_start, LocationPing.created_at <= q_end]
 
-    if shift_id:
-        try:
-            q = q.filter(LocationPing.shift_id == int(shift_id))
-        except ValueError:
-            flash("shift_id must be a number.", "error")
+    for label, raw, col in (
+        ("employee_id", employee_id, LocationPing.employee_id),
+        ("store_id", store_id, LocationPing.store_id),
+        ("shift_id", shift_id, LocationPing.shift_id),
+    ):
+        if not raw:
+            continue
+        if _INT_RE.fullmatch(raw):
+            conds.append(col == int(raw))
+        else:
+            flash(f"{label} must be a number.", "error")
 
     inside = "all"
-    if inside_raw in ("1", "true", "yes", "y", "inside"):
-        q = q.filter(LocationPing.inside_radius.is_(True))
+    inside_flag = _BOOL_MAP.get(inside_raw)
+    if inside_flag is True:
+        conds.append(LocationPing.inside_radius.is_(True))
         inside = "1"
-    elif inside_raw in ("0", "false", "no", "n", "outside"):
-        q = q.filter(LocationPing.inside_radius.is_(False))
+    elif inside_flag is False:
+        conds.append(LocationPing.inside_radius.is_(False))
         inside = "0"
 
+    # Pings are append-only: the newest matching id changes whenever the view would
+    etag = admin_list_etag(db.session.scalar(select(func.max(LocationPing.id)).where(*conds)))
+    not_modified = admin_not_modified(etag)
+    if not_modified:
+        return not_modified
+
     offset = (page - 1) * per_page
-    items = q.offset(offset).limit(per_page + 1).all()
+    # Only the columns the table renders (plus names via join) -- no ORM entities
+    items = db.session.execute(
+        select(
+            LocationPing.created_at,
+            LocationPing.shift_id,
+            LocationPing.lat,
+            LocationPing.lng,
+            LocationPing.dist_m,
+            LocationPing.inside_radius,
+            Employee.name.label("employee_name"),
+            Store.name.label("store_name"),
+        )
+        .join(Employee, LocationPing.employee_id == Employee.id)
+        .join(Store, LocationPing.store_id == Store.id)
+        .where(*conds)
+        .order_by(LocationPing.created_at.desc())
+        .offset(offset)
+        .limit(per_page + 1)
+    ).all()
     has_next = len(items) > per_page
     pings = items[:per_page]
     has_prev = page > 1
 
-    employees = Employee.query.order_by(Employee.active.desc(), Employee.name.asc()).all()
-    stores = Store.query.order_by(Store.name.asc()).all()
+    employees = db.session.scalars(
+        select(Employee).order_by(Employee.active.desc(), Employee.name.asc())
+    ).all()
+    stores = db.session.scalars(select(Store).order_by(Store.name.asc())).all()
 
+    # Capped count: stops after PINGS_COUNT_CAP matches instead of counting the whole
+    # filtered range (a window COUNT(*) OVER() would scan it all before LIMIT applied).
     try:
-        total_in_view = q.count()
+        capped = (
+            select(LocationPing.id).where(*conds)
+            .limit(PINGS_COUNT_CAP + 1)
+            .subquery()
+        )
+        total_in_view = db.session.scalar(select(func.count()).select_from(capped))
     except Exception:
+        db.session.rollback()
         total_in_view = None
+    total_capped = total_in_view is not None and total_in_view > PINGS_COUNT_CAP
+    if total_capped:
+        total_in_view = PINGS_COUNT_CAP
 
-    return render_template(
+    return admin_etag_response(render_template(
         "admin_pings.html",
         pings=pings,
         employees=employees,
@@ -2295,7 +3027,8 @@ def admin_pings():
         has_prev=has_prev,
         has_next=has_next,
         total_in_view=total_in_view,
-    )
+        total_capped=total_capped,
+    ), etag)
 
 # ✅ Admin Mobile Event Viewer
 @app.get("/admin/mobile-events")
@@ -2312,23 +3045,37 @@ def admin_mobile_events():
         limit = 200
     limit = max(25, min(limit, 500))
 
-    q = MobileEvent.query
+    conds = []
 
+    # event_type is lowercased on insert (and legacy rows at startup), so a plain
+    # equality can use ix_mobile_events_type_received
     if event_type:
-        q = q.filter(func.lower(MobileEvent.event_type) == event_type)
+        conds.append(MobileEvent.event_type == event_type)
 
     if device_uuid:
-        q = q.filter(MobileEvent.device_uuid == device_uuid)
-
-    events = q.order_by(MobileEvent.received_at.desc()).limit(limit).all()
-
-    return render_template(
+        conds.append(MobileEvent.device_uuid == device_uuid)
+
+    # Events are append-only: the newest matching id is enough to detect changes
+    etag = admin_list_etag(db.session.scalar(select(func.max(MobileEvent.id)).where(*conds)))
+    not_modified = admin_not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    events = db.session.scalars(
+        select(MobileEvent)
+        .options(*admin_list_options())
+        .where(*conds)
+        .order_by(MobileEvent.received_at.desc())
+        .limit(limit)
+    ).all()
+
+    return admin_etag_response(render_template(
         "admin_mobile_events.html",
         events=events,
         limit=limit,
         event=event_type,
         device=device_uuid,
-    )
+    ), etag)
 
 from flask import render_template
 
@@ -2347,12 +3094,8 @@ def admin_issue_detail(issue_id: int):
         flash("Issue not found.", "error")
         return redirect(url_for("admin_issues"))
 
-    # Pretty payload for template
-    payload_pretty = issue.payload_json
-    try:
-        payload_pretty = json.dumps(json.loads(issue.payload_json), indent=2, ensure_ascii=False)
-    except Exception:
-        pass
+    # Pretty payload is stored at insert; older reports are formatted on the fly
+    payload_pretty = issue.payload_pretty or _pretty_json(issue.payload_json)
 
     return render_template(
         "admin_issue_detail.html",
@@ -2409,20 +3152,36 @@ def admin_import():
         # ---------- Import STORES ----------
         if stores_file and stores_file.filename:
             try:
-                reader = csv.DictReader(TextIOWrapper(stores_file.stream, encoding="utf-8"))
+                # csv.reader + header resolved to column indices once (no dict per row)
+                reader = csv.reader(TextIOWrapper(stores_file.stream, encoding="utf-8", newline=""))
+                header = {col: idx for idx, col in enumerate(next(reader, []))}
                 required = {"name", "qr_token", "latitude", "longitude", "geofence_radius_m"}
-                missing_cols = required - set((reader.fieldnames or []))
+                missing_cols = required - header.keys()
 
                 if missing_cols:
                     store_errors.append(f"Stores CSV missing columns: {', '.join(sorted(missing_cols))}")
                 else:
-                    for i, row in enumerate(reader, start=2):
+                    # One SELECT for duplicate detection, one multi-row INSERT at the end
+                    existing_tokens = {
+                        normalize_store_code(t) for t in db.session.scalars(select(Store.qr_token))
+                    }
+                    new_stores = []
+                    name_i, token_i, lat_i, lng_i, radius_i = (
+                        header["name"], header["qr_token"], header["latitude"],
+                        header["longitude"], header["geofence_radius_m"],
+                    )
+                    width = max(header.values()) + 1
+
+                    # filter(None, ...) drops blank lines, as DictReader did
+                    for i, row in enumerate(filter(None, reader), start=2):
                         try:
-                            name = (row.get("name") or "").strip()
-                            qr_token = normalize_store_code(row.get("qr_token") or "")
-                            lat = row.get("latitude")
-                            lng = row.get("longitude")
-                            radius = row.get("geofence_radius_m") or "150"
+                            if len(row) < width:
+                                row += [None] * (width - len(row))
+                            name = (row[name_i] or "").strip()
+                            qr_token = normalize_store_code(row[token_i] or "")
+                            lat = row[lat_i]
+                            lng = row[lng_i]
+                            radius = row[radius_i] or "150"
 
                             if not name or not qr_token or lat is None or lng is None:
                                 skipped_stores += 1
@@ -2433,26 +3192,28 @@ def admin_import():
                             lng = float(lng)
                             radius = int(float(radius))
 
-                            existing = Store.query.filter(func.lower(Store.qr_token) == qr_token).first()
-                            if existing:
+                            if qr_token in existing_tokens:
                                 skipped_stores += 1
                                 continue
 
-                            s = Store(
-                                name=name,
-                                qr_token=qr_token,
-                                latitude=lat,
-                                longitude=lng,
-                                geofence_radius_m=radius
-                            )
-                            db.session.add(s)
+                            existing_tokens.add(qr_token)
+                            new_stores.append({
+                                "name": name,
+                                "qr_token": qr_token,
+                                "latitude": lat,
+                                "longitude": lng,
+                                "geofence_radius_m": radius,
+                            })
                             created_stores += 1
 
                         except Exception as e:
                             skipped_stores += 1
                             store_errors.append(f"Stores row {i}: {e}")
 
+                    if new_stores:
+                        db.session.bulk_insert_mappings(Store, new_stores)
                     db.session.commit()
+                    invalidate_store_cache()
 
             except Exception as e:
                 store_errors.append(str(e))
@@ -2460,39 +3221,51 @@ def admin_import():
         # ---------- Import EMPLOYEES ----------
         if employees_file and employees_file.filename:
             try:
-                reader = csv.DictReader(TextIOWrapper(employees_file.stream, encoding="utf-8"))
+                reader = csv.reader(TextIOWrapper(employees_file.stream, encoding="utf-8", newline=""))
+                header = {col: idx for idx, col in enumerate(next(reader, []))}
                 required = {"name", "pin"}
-                missing_cols = required - set((reader.fieldnames or []))
+                missing_cols = required - header.keys()
 
                 if missing_cols:
                     emp_errors.append(f"Employees CSV missing columns: {', '.join(sorted(missing_cols))}")
                 else:
-                    for i, row in enumerate(reader, start=2):
+                    existing_pins = set(db.session.scalars(select(Employee.pin)))
+                    new_emps = []
+                    name_i, pin_i = header["name"], header["pin"]
+                    active_i = header.get("active")  # optional column
+                    width = max(header.values()) + 1
+
+                    for i, row in enumerate(filter(None, reader), start=2):
                         try:
-                            name = (row.get("name") or "").strip()
-                            pin = (row.get("pin") or "").strip()
-                            active_raw = (row.get("active") or "1").strip().lower()
+                            if len(row) < width:
+                                row += [None] * (width - len(row))
+                            name = (row[name_i] or "").strip()
+                            pin = (row[pin_i] or "").strip()
+                            active_raw = ((row[active_i] if active_i is not None else None) or "1").strip().lower()
 
                             if not name or not pin:
                                 skipped_emps += 1
                                 emp_errors.append(f"Employees row {i}: missing name or pin")
                                 continue
 
-                            active = active_raw not in ("0", "false", "no", "n")
+                            active = _BOOL_MAP.get(active_raw) is not False
 
-                            if Employee.query.filter_by(pin=pin).first():
+                            if pin in existing_pins:
                                 skipped_emps += 1
                                 continue
 
-                            e = Employee(name=name, pin=pin, active=active)
-                            db.session.add(e)
+                            existing_pins.add(pin)
+                            new_emps.append({"name": name, "pin": pin, "active": active})
                             created_emps += 1
 
                         except Exception as e:
                             skipped_emps += 1
                             emp_errors.append(f"Employees row {i}: {e}")
 
+                    if new_emps:
+                        db.session.bulk_insert_mappings(Employee, new_emps)
                     db.session.commit()
+                    invalidate_employee_cache()
 
             except Exception as e:
                 emp_errors.append(str(e))
@@ -2544,6 +3317,7 @@ def admin_employees():
                     e = Employee(name=name, pin=pin, active=True)
                     db.session.add(e)
                     db.session.commit()
+                    invalidate_employee_cache()
                     flash("Employee created.", "success")
 
         elif action == "toggle_active":
@@ -2552,6 +3326,7 @@ def admin_employees():
             if emp:
                 emp.active = not emp.active
                 db.session.commit()
+                invalidate_employee_cache()
                 flash(f"Employee {'activated' if emp.active else 'deactivated'}.", "success")
 
     view = (request.args.get("view") or "active").strip().lower()
@@ -2674,6 +3449,8 @@ def admin_employees_update():
     emp.pin = pin
     emp.active = active
     db.session.commit()
+    invalidate_employee_cache()
+    invalidate_payroll_cache()  # payroll rows carry the employee name
 
     flash("Employee updated.", "success")
     return redirect(url_for("admin_employees"))
@@ -2696,6 +3473,7 @@ def admin_employees_delete():
 
     db.session.delete(emp)
     db.session.commit()
+    invalidate_employee_cache()
     flash("Employee deleted.", "success")
     return redirect(url_for("admin_employees"))
 
@@ -2724,7 +3502,7 @@ def admin_stores():
                 except ValueError:
                     flash("Invalid lat/lng/radius.", "error")
                 else:
-                    existing = Store.query.filter(func.lower(Store.qr_token) == qr_token).first()
+                    existing = Store.query.filter(Store.qr_token == qr_token).first()
                     if existing:
                         flash("Store code already in use.", "error")
                     else:
@@ -2737,6 +3515,7 @@ def admin_stores():
                         )
                         db.session.add(s)
                         db.session.commit()
+                        invalidate_store_cache()
                         flash("Store created.", "success")
 
     stores = Store.query.order_by(Store.name.asc()).all()
@@ -2771,7 +3550,7 @@ def admin_stores_update():
         flash("Invalid lat/lng/radius.", "error")
         return redirect(url_for("admin_stores"))
 
-    existing = Store.query.filter(func.lower(Store.qr_token) == qr_token, Store.id != store.id).first()
+    existing = Store.query.filter(Store.qr_token == qr_token, Store.id != store.id).first()
     if existing:
         flash("Store code already in use.", "error")
         return redirect(url_for("admin_stores"))
@@ -2782,6 +3561,8 @@ def admin_stores_update():
     store.longitude = lng
     store.geofence_radius_m = radius
     db.session.commit()
+    invalidate_store_cache()
+    invalidate_payroll_cache()  # payroll rows carry the store name
 
     flash("Store updated.", "success")
     return redirect(url_for("admin_stores"))
@@ -2804,6 +3585,7 @@ def admin_stores_delete():
 
     db.session.delete(store)
     db.session.commit()
+    invalidate_store_cache()
     flash("Store deleted.", "success")
     return redirect(url_for("admin_stores"))
 
@@ -2812,10 +3594,28 @@ def admin_shifts():
     guard = admin_guard()
     if guard: return guard
 
-    shifts = Shift.query.order_by(
-        Shift.clock_out.is_(None).desc(),
-        Shift.clock_in.desc()
-    ).limit(300).all()
+    limit = 300
+    # Only the columns shifts.html renders; rows still work with shift_minutes()
+    base = (
+        select(
+            Shift.id,
+            Shift.clock_in,
+            Shift.clock_out,
+            Employee.name.label("employee_name"),
+            Store.name.label("store_name"),
+        )
+        .join(Employee, Shift.employee_id == Employee.id)
+        .join(Store, Shift.store_id == Store.id)
+        .order_by(Shift.clock_in.desc())
+    )
+
+    # Open shifts first, then most recent closed ones. Two index-ordered queries
+    # instead of ORDER BY (clock_out IS NULL) which forces a full-table sort.
+    shifts = db.session.execute(base.where(Shift.clock_out.is_(None)).limit(limit)).all()
+    if len(shifts) < limit:
+        shifts += db.session.execute(
+            base.where(Shift.clock_out.isnot(None)).limit(limit - len(shifts))
+        ).all()
 
     return render_template("shifts.html", shifts=shifts)
 
@@ -2836,6 +3636,7 @@ def admin_close_shift():
 
     s.clock_out = now_utc()
     db.session.commit()
+    invalidate_payroll_cache()
     flash("Shift closed.", "success")
     return redirect(url_for("admin_shifts"))
 
@@ -2877,6 +3678,7 @@ def admin_force_close_shift():
     )
     db.session.add(audit)
     db.session.commit()
+    invalidate_payroll_cache()
 
     flash("Shift force-closed (admin override).", "success")
     return redirect(url_for("admin_shifts"))
@@ -2940,6 +3742,7 @@ def admin_shift_new():
         )
         db.session.add(audit)
         db.session.commit()
+        invalidate_payroll_cache()
 
         flash("Manual shift created.", "success")
         return redirect(url_for("admin_shifts"))
@@ -2981,111 +3784,323 @@ def admin_shift_edit(shift_id: int):
             flash("Clock-out must be after clock-in.", "error")
             return render_template("admin_shift_edit.html", s=s, employees=employees, stores=stores)
 
-        old_in = s.clock_in
-        old_out = s.clock_out
-
-        s.employee_id = int(employee_id) if employee_id else s.employee_id
-        s.store_id = int(store_id) if store_id else s.store_id
-        s.clock_in = cin
-        s.clock_out = cout
-
-        s.closed_by_admin = True
-        s.admin_closed_by = admin_username()
-        s.admin_closed_at = now_utc()
-        s.admin_close_reason = reason
-
-        audit = ShiftEditAudit(
-            shift_id=s.id,
-            action="edit",
-            editor=admin_username(),
-            reason=reason,
-            old_clock_in=old_in,
-            old_clock_out=old_out,
-            new_clock_in=s.clock_in,
-            new_clock_out=s.clock_out
+        editor = admin_username()
+        edited_at = now_utc()
+        new_employee_id = int(employee_id) if employee_id else s.employee_id
+        new_store_id = int(store_id) if store_id else s.store_id
+
+        # Core UPDATE + INSERT in one transaction: one commit / WAL flush for both,
+        # no audit ORM object to build. old_* come from the already-loaded row.
+        db.session.execute(
+            update(Shift)
+            .where(Shift.id == s.id)
+            .values(
+                employee_id=new_employee_id,
+                store_id=new_store_id,
+                clock_in=cin,
+                clock_out=cout,
+                closed_by_admin=True,
+                admin_closed_by=editor,
+                admin_closed_at=edited_at,
+                admin_close_reason=reason,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            ShiftEditAudit.__table__.insert().values(
+                shift_id=s.id,
+                action="edit",
+                editor=editor,
+                reason=reason,
+                old_clock_in=s.clock_in,
+                old_clock_out=s.clock_out,
+                new_clock_in=cin,
+                new_clock_out=cout,
+                created_at=edited_at,
+            )
         )
-        db.session.add(audit)
         db.session.commit()
+        invalidate_payroll_cache()
 
         flash("Shift updated (audit logged).", "success")
         return redirect(url_for("admin_shifts"))
 
     return render_template("admin_shift_edit.html", s=s, employees=employees, stores=stores)
 
+AUDIT_PAGE_SIZE = 50
+
 @app.get("/admin/audit")
 def admin_audit():
     guard = admin_guard()
     if guard: return guard
 
-    audits = ShiftEditAudit.query.order_by(ShiftEditAudit.created_at.desc()).limit(500).all()
-    return render_template("admin_audit.html", audits=audits)
+    # Keyset pagination: ?before=<created_at iso>&before_id=<id> from the last row shown.
+    # Each page is an index seek on ix_shift_edit_audit_created_at, not a re-scan.
+    stmt = select(ShiftEditAudit).options(*admin_list_options())
+
+    before_raw = (request.args.get("before") or "").strip()
+    before_id_raw = (request.args.get("before_id") or "").strip()
+    if before_raw:
+        try:
+            before = datetime.fromisoformat(before_raw)
+        except ValueError:
+            before = None
+        if before is not None:
+            cond = ShiftEditAudit.created_at < before
+            if _INT_RE.fullmatch(before_id_raw):
+                # same-timestamp rows are ordered by id
+                cond = or_(cond, and_(ShiftEditAudit.created_at == before, ShiftEditAudit.id < int(before_id_raw)))
+            stmt = stmt.where(cond)
+
+    # template only renders audit columns (shift_id, not the Shift relationship)
+    audits = db.session.scalars(
+        stmt.order_by(ShiftEditAudit.created_at.desc(), ShiftEditAudit.id.desc())
+        .limit(AUDIT_PAGE_SIZE + 1)
+    ).all()
+
+    next_cursor = None
+    if len(audits) > AUDIT_PAGE_SIZE:
+        audits = audits[:AUDIT_PAGE_SIZE]
+        last = audits[-1]
+        next_cursor = {"before": last.created_at.isoformat(), "before_id": last.id}
+
+    return render_template(
+        "admin_audit.html",
+        audits=audits,
+        next_cursor=next_cursor,
+        paged=bool(before_raw),
+    )
 
 # -----------------------------
 # ✅ Payroll (unchanged)
 # -----------------------------
-@app.get("/admin/payroll")
-def admin_payroll():
-    guard = admin_guard()
-    if guard: return guard
+# XLSX export: cell formats (XlsxWriter format properties, one Format per workbook)
+XLSX_WRAP = {"text_wrap": True, "valign": "top"}
+XLSX_HEADER = {**XLSX_WRAP, "bold": True}
+XLSX_COL_WIDTH = 25
+
+# Header rows shared by the HTML grid, CSV and XLSX exports (built once, not per request)
+PAYROLL_DAY_HEADERS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+PAYROLL_GRID_HEADERS = ("Employee", *PAYROLL_DAY_HEADERS, "Total")
+PAYROLL_DETAIL_HEADERS = ("Employee", "Store", "Clock In", "Clock Out", "Minutes", "Time (Short)")
+_EMPTY_WEEK = ("",) * 7  # blank day cells for the GRAND TOTAL row
+
+class _EchoWriter:
+    """
+    File-like for csv.writer that hands each formatted line back instead of buffering it.
+    """
+    def write(self, value):
+        return value
 
-    start_str = request.args.get("start")
-    end_str = request.args.get("end")
-    out_format = (request.args.get("format") or "").lower()
+def _pg_shift_minutes():
+    """
+    SQL twin of shift_minutes() for closed shifts: whole minutes, never negative (Postgres).
+    """
+    return func.floor(func.greatest(extract("epoch", Shift.clock_out - Shift.clock_in), 0) / 60)
 
-    if start_str and end_str:
-        try:
-            start_date = datetime.strptime(start_str, "%Y-%m-%d").date()
-            end_date = datetime.strptime(end_str, "%Y-%m-%d").date()
-            if APP_TZ:
-                start_dt = datetime.combine(start_date, dtime.min, tzinfo=APP_TZ)
-                end_dt = datetime.combine(end_date, dtime.max, tzinfo=APP_TZ)
-            else:
-                start_dt = datetime.combine(start_date, dtime.min)
-                end_dt = datetime.combine(end_date, dtime.max)
-        except ValueError:
-            flash("Invalid start/end date format. Use YYYY-MM-DD.", "error")
-            start_dt, end_dt = last_completed_payroll_week()
-    else:
-        start_dt, end_dt = last_completed_payroll_week()
+def _pg_local(col):
+    """
+    SQL twin of utc_naive_to_local() for a naive-UTC timestamp column (Postgres).
+    """
+    tz_name = getattr(APP_TZ, "key", None) or "UTC"
+    return func.timezone(tz_name, func.timezone("UTC", col))
 
-    q_start, q_end = local_range_to_utc_naive(start_dt, end_dt)
+def _pg_clock_in_weekday():
+    """
+    SQL twin of utc_naive_to_local(clock_in).weekday(): Mon=0 ... Sun=6 (Postgres).
+    """
+    return extract("isodow", _pg_local(Shift.clock_in)) - 1
 
-    shifts = Shift.query.filter(
-        Shift.clock_out.isnot(None),
-        Shift.clock_out >= q_start,
-        Shift.clock_out <= q_end
-    ).order_by(Shift.clock_out.asc()).all()
+def _pg_fmt_dt(col):
+    """
+    SQL twin of fmt_dt(): same "YYYY-MM-DD HH:MM AM" text, formatted by Postgres.
+    """
+    return func.to_char(_pg_local(col), "YYYY-MM-DD HH12:MI AM")
 
-    rows = []
-    totals_by_emp_min = {}
-    weekly_map: dict[str, dict[int, dict[str, int]]] = {}
+def _payroll_weekly_minutes(q_start: datetime, q_end: datetime):
+    """
+    Postgres: aggregate payroll minutes per (employee, clock-in local weekday, store)
+    with one GROUP BY. Each shift is floored to whole minutes before summing, same
+    as shift_minutes(). Returns (weekly_map, totals_by_emp_min), or None on other
+    dialects (the caller aggregates in Python).
+    """
+    if db.engine.dialect.name != "postgresql":
+        return None
+
+    weekday = _pg_clock_in_weekday().label("wd")
+    minutes = func.sum(_pg_shift_minutes()).label("minutes")
+
+    agg = db.session.execute(
+        select(Employee.name, Store.name, weekday, minutes)
+        .join(Employee, Shift.employee_id == Employee.id)
+        .join(Store, Shift.store_id == Store.id)
+        .where(
+            Shift.clock_out.isnot(None),
+            Shift.clock_out >= q_start,
+            Shift.clock_out <= q_end,
+        )
+        .group_by(Employee.name, Store.name, weekday)
+    ).all()
+
+    weekly_map: dict[str, list[dict[str, int] | None]] = {}
+    totals_by_emp_min: Counter[str] = Counter()
+    for emp_name, store_name, wd, m in agg:
+        m = int(m or 0)
+        buckets = weekly_map.setdefault(emp_name, [None] * 7)
+        wd = int(wd)
+        if buckets[wd] is None:
+            buckets[wd] = {}
+        buckets[wd][store_name] = m
+        totals_by_emp_min[emp_name] += m
+    return weekly_map, totals_by_emp_min
+
+def _build_grid_rows(sorted_employees: list[str], day_stores: dict[str, list]) -> list[dict]:
+    """
+    Weekly grid shared by the HTML page and CSV/XLSX exports:
+    [{"employee", "days": [Mon..Sun cell text], "total"}].
+    """
+    grid_rows = []
+    for emp_name in sorted_employees:
+        day_cells = []
+        total_emp = 0
 
-    for s in shifts:
-        mins = shift_minutes(s)
-        emp_name = s.employee.name
-        store_name = s.store.name
+        for stores_for_day in day_stores[emp_name]:  # Mon..Sun
+            if not stores_for_day:
+                day_cells.append("0h 00m")
+                continue
 
-        rows.append({
+            parts = []
+            for store_name, m in stores_for_day:
+                total_emp += m
+                parts.append(f"{store_name} {minutes_to_short(m)}")
+
+            day_cells.append("; ".join(parts))
+
+        grid_rows.append({
             "employee": emp_name,
-            "store": store_name,
-            "clock_in": fmt_dt(s.clock_in),
-            "clock_out": fmt_dt(s.clock_out),
-            "minutes": mins,
-            "human_short": minutes_to_short(mins),
+            "days": day_cells,
+            "total": minutes_to_short(total_emp),
         })
-        totals_by_emp_min[emp_name] = totals_by_emp_min.get(emp_name, 0) + mins
+    return grid_rows
+
+class PayrollData(NamedTuple):
+    # shift detail rows aren't held here: they're streamed per request (iter_payroll_detail_rows)
+    summary: list[dict]              # per-employee totals, name order
+    grid_rows: list[dict]            # weekly grid, see _build_grid_rows()
+    grand_minutes: int
+
+# Admins flip between the HTML grid and CSV/XLSX exports for the same week.
+# TTL bounds staleness across workers; local admin shift edits clear it.
+PAYROLL_CACHE_TTL_S = 60.0
+PAYROLL_CACHE_MAX = 32
+
+_payroll_cache: dict[tuple[datetime, datetime], tuple[float, PayrollData]] = {}
+
+def invalidate_payroll_cache():
+    _payroll_cache.clear()
+
+def payroll_data(q_start: datetime, q_end: datetime) -> PayrollData:
+    key = (q_start, q_end)
+    hit = _payroll_cache.get(key)
+    if hit and (time.monotonic() - hit[0]) < PAYROLL_CACHE_TTL_S:
+        return hit[1]
+
+    data = _build_payroll_data(q_start, q_end)
+    if len(_payroll_cache) >= PAYROLL_CACHE_MAX:
+        _payroll_cache.clear()
+    _payroll_cache[key] = (time.monotonic(), data)
+    return data
+
+PAYROLL_DETAIL_BATCH = 1000
+
+def _payroll_detail_stmt(q_start: datetime, q_end: datetime, on_pg: bool):
+    # names via join; on Postgres minutes and display times come from the database too
+    detail_cols = [
+        Employee.name.label("employee"),
+        Store.name.label("store"),
+        Shift.clock_in,
+        Shift.clock_out,
+    ]
+    if on_pg:
+        detail_cols += [
+            _pg_shift_minutes().label("mins"),
+            _pg_fmt_dt(Shift.clock_in).label("clock_in_text"),
+            _pg_fmt_dt(Shift.clock_out).label("clock_out_text"),
+        ]
+    return (
+        select(*detail_cols)
+        .join(Employee, Shift.employee_id == Employee.id)
+        .join(Store, Shift.store_id == Store.id)
+        .where(
+            Shift.clock_out.isnot(None),
+            Shift.clock_out >= q_start,
+            Shift.clock_out <= q_end
+        )
+        .order_by(Shift.clock_out.asc())
+    )
 
-        cin_local = utc_naive_to_local(s.clock_in)
-        wd = cin_local.weekday()  # Mon=0 ... Sun=6
+def _stream_payroll_shifts(q_start: datetime, q_end: datetime, on_pg: bool):
+    # server-side cursor on Postgres, fetched PAYROLL_DETAIL_BATCH rows at a time
+    return db.session.execute(
+        _payroll_detail_stmt(q_start, q_end, on_pg),
+        execution_options={"stream_results": True, "yield_per": PAYROLL_DETAIL_BATCH},
+    )
+
+def iter_payroll_detail_rows(q_start: datetime, q_end: datetime):
+    """
+    Shift detail rows (clock-out order), formatted one at a time as the cursor
+    yields them. CSV/XLSX exports write each row straight out, so memory stays
+    ~one fetch batch regardless of window size.
+    """
+    on_pg = db.engine.dialect.name == "postgresql"
+    for s in _stream_payroll_shifts(q_start, q_end, on_pg):
+        if on_pg:
+            mins = int(s.mins)
+            clock_in, clock_out = s.clock_in_text, s.clock_out_text
+        else:
+            mins = shift_minutes(s)
+            clock_in, clock_out = fmt_dt(s.clock_in), fmt_dt(s.clock_out)
+        yield {
+            "employee": s.employee,
+            "store": s.store,
+            "clock_in": clock_in,
+            "clock_out": clock_out,
+            "minutes": mins,
+            "human_short": minutes_to_short(mins),
+        }
 
-        if emp_name not in weekly_map:
-            weekly_map[emp_name] = {}
-        if wd not in weekly_map[emp_name]:
-            weekly_map[emp_name][wd] = {}
-        weekly_map[emp_name][wd][store_name] = weekly_map[emp_name][wd].get(store_name, 0) + mins
+def _build_payroll_data(q_start: datetime, q_end: datetime) -> PayrollData:
+    # Weekly grid + totals come pre-aggregated from SQL where supported;
+    # otherwise (SQLite) they're summed from the streamed shifts.
+    aggregated = _payroll_weekly_minutes(q_start, q_end)
+    if aggregated:
+        weekly_map, totals_by_emp_min = aggregated
+    else:
+        totals_by_emp_min: Counter[str] = Counter()
+        # emp -> 7 weekday slots (Mon=0), each None or {store: minutes}
+        weekly_map: dict[str, list[dict[str, int] | None]] = {}
+
+        for s in _stream_payroll_shifts(q_start, q_end, on_pg=False):
+            mins = shift_minutes(s)
+            totals_by_emp_min[s.employee] += mins
+
+            cin_local = utc_naive_to_local(s.clock_in)
+            wd = cin_local.weekday()  # Mon=0 ... Sun=6
+
+            buckets = weekly_map.setdefault(s.employee, [None] * 7)
+            if buckets[wd] is None:
+                buckets[wd] = defaultdict(int)
+            buckets[wd][s.store] += mins
+
+    # Sort once: employees, and each employee-day's stores as (name, minutes)
+    sorted_employees = sorted(weekly_map, key=str.lower)
+    day_stores = {
+        emp: [sorted(stores.items(), key=lambda kv: kv[0].lower()) if stores else None for stores in buckets]
+        for emp, buckets in weekly_map.items()
+    }
 
     summary = []
-    for emp_name in sorted(totals_by_emp_min.keys(), key=lambda x: x.lower()):
+    for emp_name in sorted_employees:
         m = totals_by_emp_min[emp_name]
         summary.append({
             "employee": emp_name,
@@ -3095,141 +4110,231 @@ def admin_payroll():
             "hours_decimal": minutes_to_decimal_hours(m, places=4),
         })
 
-    grand_minutes = sum(totals_by_emp_min.values())
-    grand_human = minutes_to_human(grand_minutes)
-    grand_human_short = minutes_to_short(grand_minutes)
-    grand_hours_decimal = minutes_to_decimal_hours(grand_minutes, places=4)
+    return PayrollData(
+        summary=summary,
+        grid_rows=_build_grid_rows(sorted_employees, day_stores),
+        grand_minutes=sum(totals_by_emp_min.values()),
+    )
 
-    if out_format == "csv":
-        from io import StringIO
+def _write_payroll_xlsx(target, start_dt: datetime, end_dt: datetime, data: PayrollData, detail_rows):
+    """
+    Payroll workbook (Weekly grid + Shift Detail) written to a path or file-like.
+    detail_rows is any iterable of detail dicts (normally iter_payroll_detail_rows()).
+    constant_memory flushes each row to a temp file as it's written (rows must
+    go top-to-bottom, which they do); memory stays ~one row.
+    """
+    wb = xlsxwriter.Workbook(target, {"constant_memory": True, "strings_to_urls": False})
+    header_fmt = wb.add_format(XLSX_HEADER)
+    wrap = wb.add_format(XLSX_WRAP)
+
+    ws = wb.add_worksheet("Weekly")
+    ws.set_column(0, len(PAYROLL_GRID_HEADERS) - 1, XLSX_COL_WIDTH)
+    ws.freeze_panes(5, 0)
+
+    ws.write_row(0, 0, ["Payroll Week Start (local)", start_dt.date().isoformat()], wrap)
+    ws.write_row(1, 0, ["Payroll Week End (local)", end_dt.date().isoformat()], wrap)
+    ws.write_row(2, 0, ["Note", "Weekly filter uses CLOCK-OUT date; day columns assign time to CLOCK-IN day (local)."], wrap)
+    ws.write_row(4, 0, PAYROLL_GRID_HEADERS, header_fmt)
+    r_idx = 5
 
-        si = StringIO()
-        w = csv.writer(si)
+    for gr in data.grid_rows:
+        ws.write_row(r_idx, 0, [gr["employee"]] + gr["days"] + [gr["total"]], wrap)
+        r_idx += 1
 
-        w.writerow(["Payroll Week Start (local)", start_dt.date().isoformat()])
-        w.writerow(["Payroll Week End (local)", end_dt.date().isoformat()])
-        w.writerow(["Note", "Weekly filter uses CLOCK-OUT date; day columns assign time to CLOCK-IN day (local)."])
-        w.writerow([])
+    ws.write_row(r_idx, 0, ("GRAND TOTAL", *_EMPTY_WEEK, minutes_to_short(data.grand_minutes)), wrap)
 
-        day_headers = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-        w.writerow(["Employee"] + day_headers + ["Total"])
+    ws2 = wb.add_worksheet("Shift Detail")
+    ws2.set_column(0, len(PAYROLL_DETAIL_HEADERS) - 1, XLSX_COL_WIDTH)
+    ws2.freeze_panes(1, 0)
 
-        for emp_name in sorted(weekly_map.keys(), key=lambda x: x.lower()):
-            day_cells = []
-            total_emp = 0
+    ws2.write_row(0, 0, PAYROLL_DETAIL_HEADERS, header_fmt)
+    for r_idx, r in enumerate(detail_rows, start=1):
+        ws2.write_row(r_idx, 0, [r["employee"], r["store"], r["clock_in"], r["clock_out"], r["minutes"], r["human_short"]], wrap)
 
-            for wd in range(7):
-                stores_for_day = weekly_map.get(emp_name, {}).get(wd, {})
-                if not stores_for_day:
-                    day_cells.append("0h 00m")
-                    continue
+    wb.close()
 
-                parts = []
-                for store_name in sorted(stores_for_day.keys(), key=lambda x: x.lower()):
-                    m = stores_for_day[store_name]
-                    total_emp += m
-                    parts.append(f"{store_name} {minutes_to_short(m)}")
+# -----------------------------
+# Background payroll XLSX export
+# -----------------------------
+# ?format=xlsx&background=1 builds the workbook on a daemon thread and returns a
+# job id. Job state lives on disk (not in memory) so any gunicorn worker on the
+# host can answer the status/download polls:
+#   <id>.pending -> running, <id>.xlsx -> done, <id>.err -> failed
+PAYROLL_EXPORT_DIR = os.path.join(tempfile.gettempdir(), "clockin_payroll_exports")
+PAYROLL_EXPORT_MAX_AGE_S = 3600
 
-                day_cells.append("; ".join(parts))
+# job id = "<start>_<end>_<hex>" so the download name needs no extra state
+_EXPORT_JOB_RE = re.compile(r"(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})_[0-9a-f]{32}")
 
-            w.writerow([emp_name] + day_cells + [minutes_to_short(total_emp)])
+def _payroll_export_path(job_id: str, ext: str) -> str:
+    return os.path.join(PAYROLL_EXPORT_DIR, f"{job_id}{ext}")
 
-        w.writerow(["GRAND TOTAL"] + [""] * 7 + [grand_human_short])
-        w.writerow([])
+def _prune_payroll_exports():
+    cutoff = time.time() - PAYROLL_EXPORT_MAX_AGE_S
+    try:
+        for entry in os.scandir(PAYROLL_EXPORT_DIR):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+    except OSError:
+        pass
 
-        w.writerow(["Shift Detail"])
-        w.writerow(["Employee", "Store", "Clock In", "Clock Out", "Minutes", "Time (Short)"])
-        for r in rows:
-            w.writerow([r["employee"], r["store"], r["clock_in"], r["clock_out"], r["minutes"], r["human_short"]])
+def _run_payroll_xlsx_job(job_id: str, q_start, q_end, start_dt, end_dt):
+    try:
+        part = _payroll_export_path(job_id, ".xlsx.part")
+        with app.app_context():
+            data = payroll_data(q_start, q_end)
+            _write_payroll_xlsx(part, start_dt, end_dt, data, iter_payroll_detail_rows(q_start, q_end))
+        os.replace(part, _payroll_export_path(job_id, ".xlsx"))
+    except Exception:
+        app.logger.exception("PAYROLL_EXPORT_FAILED job=%s", job_id)
+        with open(_payroll_export_path(job_id, ".err"), "w"):
+            pass
+    finally:
+        try:
+            os.remove(_payroll_export_path(job_id, ".pending"))
+        except OSError:
+            pass
 
-        output = si.getvalue()
-        filename = f"payroll_{start_dt.date().isoformat()}_to_{end_dt.date().isoformat()}.csv"
-        return Response(
-            output,
-            mimetype="text/csv",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+def start_payroll_xlsx_job(q_start, q_end, start_dt, end_dt) -> str:
+    os.makedirs(PAYROLL_EXPORT_DIR, exist_ok=True)
+    _prune_payroll_exports()
 
-    if out_format == "xlsx":
-        from io import BytesIO
+    job_id = f"{start_dt.date().isoformat()}_{end_dt.date().isoformat()}_{uuid.uuid4().hex}"
+    with open(_payroll_export_path(job_id, ".pending"), "w"):
+        pass
+    threading.Thread(
+        target=_run_payroll_xlsx_job,
+        args=(job_id, q_start, q_end, start_dt, end_dt),
+        name=f"payroll-export-{job_id[-8:]}",
+        daemon=True,
+    ).start()
+    log_event("PAYROLL_EXPORT_QUEUED", job_id=job_id, editor=admin_username())
+    return job_id
+
+@app.get("/admin/payroll/export/<job_id>")
+def admin_payroll_export_status(job_id: str):
+    guard = admin_guard()
+    if guard: return guard
+
+    if not _EXPORT_JOB_RE.fullmatch(job_id):
+        return jsonify({"ok": False, "error": "invalid_job_id"}), 400
+
+    if os.path.exists(_payroll_export_path(job_id, ".xlsx")):
+        status = "done"
+    elif os.path.exists(_payroll_export_path(job_id, ".err")):
+        status = "failed"
+    elif os.path.exists(_payroll_export_path(job_id, ".pending")):
+        status = "running"
+    else:
+        return jsonify({"ok": False, "error": "unknown_job"}), 404
 
-        wb = Workbook()
-        header_font = Font(bold=True)
-        wrap = Alignment(wrap_text=True, vertical="top")
+    payload = {"ok": True, "job_id": job_id, "status": status}
+    if status == "done":
+        payload["download_url"] = url_for("admin_payroll_export_download", job_id=job_id)
+    return jsonify(payload)
 
-        ws = wb.active
-        ws.title = "Weekly"
+@app.get("/admin/payroll/download/<job_id>")
+def admin_payroll_export_download(job_id: str):
+    guard = admin_guard()
+    if guard: return guard
 
-        ws.append(["Payroll Week Start (local)", start_dt.date().isoformat()])
-        ws.append(["Payroll Week End (local)", end_dt.date().isoformat()])
-        ws.append(["Note", "Weekly filter uses CLOCK-OUT date; day columns assign time to CLOCK-IN day (local)."])
-        ws.append([])
+    m = _EXPORT_JOB_RE.fullmatch(job_id)
+    if not m:
+        return jsonify({"ok": False, "error": "invalid_job_id"}), 400
 
-        headers = ["Employee", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun", "Total"]
-        ws.append(headers)
+    path = _payroll_export_path(job_id, ".xlsx")
+    if not os.path.exists(path):
+        return jsonify({"ok": False, "error": "not_ready"}), 404
 
-        for col_idx in range(1, len(headers) + 1):
-            c = ws.cell(row=ws.max_row, column=col_idx)
-            c.font = header_font
-            c.alignment = wrap
+    return send_file(
+        path,
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        as_attachment=True,
+        download_name=f"payroll_{m.group(1)}_to_{m.group(2)}.xlsx",
+    )
 
-        for emp_name in sorted(weekly_map.keys(), key=lambda x: x.lower()):
-            day_cells = []
-            total_emp = 0
+@app.get("/admin/payroll")
+def admin_payroll():
+    guard = admin_guard()
+    if guard: return guard
 
-            for wd in range(7):
-                stores_for_day = weekly_map.get(emp_name, {}).get(wd, {})
-                if not stores_for_day:
-                    day_cells.append("0h 00m")
-                    continue
+    start_str = request.args.get("start")
+    end_str = request.args.get("end")
+    out_format = (request.args.get("format") or "").lower()
 
-                parts = []
-                for store_name in sorted(stores_for_day.keys(), key=lambda x: x.lower()):
-                    m = stores_for_day[store_name]
-                    total_emp += m
-                    parts.append(f"{store_name} {minutes_to_short(m)}")
+    if start_str and end_str:
+        try:
+            start_date = datetime.strptime(start_str, "%Y-%m-%d").date()
+            end_date = datetime.strptime(end_str, "%Y-%m-%d").date()
+            if APP_TZ:
+                start_dt = datetime.combine(start_date, dtime.min, tzinfo=APP_TZ)
+                end_dt = datetime.combine(end_date, dtime.max, tzinfo=APP_TZ)
+            else:
+                start_dt = datetime.combine(start_date, dtime.min)
+                end_dt = datetime.combine(end_date, dtime.max)
+        except ValueError:
+            flash("Invalid start/end date format. Use YYYY-MM-DD.", "error")
+            start_dt, end_dt = last_completed_payroll_week()
+    else:
+        start_dt, end_dt = last_completed_payroll_week()
 
-                day_cells.append("; ".join(parts))
+    q_start, q_end = local_range_to_utc_naive(start_dt, end_dt)
 
-            ws.append([emp_name] + day_cells + [minutes_to_short(total_emp)])
+    # big windows: build off-request and hand back a job to poll
+    if out_format == "xlsx" and request.args.get("background") == "1":
+        job_id = start_payroll_xlsx_job(q_start, q_end, start_dt, end_dt)
+        return jsonify({
+            "ok": True,
+            "job_id": job_id,
+            "status_url": url_for("admin_payroll_export_status", job_id=job_id),
+            "download_url": url_for("admin_payroll_export_download", job_id=job_id),
+        }), 202
 
-        ws.append(["GRAND TOTAL", "", "", "", "", "", "", "", grand_human_short])
+    data = payroll_data(q_start, q_end)
+    summary = data.summary
+    grid_rows = data.grid_rows
 
-        max_col = len(headers)
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=max_col):
-            for cell in row:
-                cell.alignment = wrap
+    grand_minutes = data.grand_minutes
+    grand_human = minutes_to_human(grand_minutes)
+    grand_human_short = minutes_to_short(grand_minutes)
+    grand_hours_decimal = minutes_to_decimal_hours(grand_minutes, places=4)
 
-        for col_idx in range(1, max_col + 1):
-            ws.column_dimensions[get_column_letter(col_idx)].width = 25
+    if out_format == "csv":
+        def generate():
+            # rows are yielded as they're formatted; no full-file buffer, and the
+            # detail section reads the streamed cursor directly
+            w = csv.writer(_EchoWriter())
 
-        ws.freeze_panes = "A6"
+            yield w.writerow(["Payroll Week Start (local)", start_dt.date().isoformat()])
+            yield w.writerow(["Payroll Week End (local)", end_dt.date().isoformat()])
+            yield w.writerow(["Note", "Weekly filter uses CLOCK-OUT date; day columns assign time to CLOCK-IN day (local)."])
+            yield w.writerow([])
 
-        ws2 = wb.create_sheet("Shift Detail")
-        detail_headers = ["Employee", "Store", "Clock In", "Clock Out", "Minutes", "Time (Short)"]
-        ws2.append(detail_headers)
+            yield w.writerow(PAYROLL_GRID_HEADERS)
 
-        for col_idx in range(1, len(detail_headers) + 1):
-            c = ws2.cell(row=1, column=col_idx)
-            c.font = header_font
-            c.alignment = wrap
+            for gr in grid_rows:
+                yield w.writerow([gr["employee"]] + gr["days"] + [gr["total"]])
 
-        for r in rows:
-            ws2.append([r["employee"], r["store"], r["clock_in"], r["clock_out"], r["minutes"], r["human_short"]])
+            yield w.writerow(("GRAND TOTAL", *_EMPTY_WEEK, grand_human_short))
+            yield w.writerow([])
 
-        max_col2 = len(detail_headers)
-        for row in ws2.iter_rows(min_row=1, max_row=ws2.max_row, min_col=1, max_col=max_col2):
-            for cell in row:
-                cell.alignment = wrap
+            yield w.writerow(["Shift Detail"])
+            yield w.writerow(PAYROLL_DETAIL_HEADERS)
+            for r in iter_payroll_detail_rows(q_start, q_end):
+                yield w.writerow([r["employee"], r["store"], r["clock_in"], r["clock_out"], r["minutes"], r["human_short"]])
 
-        for col_idx in range(1, max_col2 + 1):
-            ws2.column_dimensions[get_column_letter(col_idx)].width = 25
+        filename = f"payroll_{start_dt.date().isoformat()}_to_{end_dt.date().isoformat()}.csv"
+        return Response(
+            stream_with_context(generate()),  # keeps the DB session alive while streaming
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
 
-        ws2.freeze_panes = "A2"
+    if out_format == "xlsx":
+        from io import BytesIO
 
         bio = BytesIO()
-        wb.save(bio)
-        bio.seek(0)
+        _write_payroll_xlsx(bio, start_dt, end_dt, data, iter_payroll_detail_rows(q_start, q_end))
 
         filename = f"payroll_{start_dt.date().isoformat()}_to_{end_dt.date().isoformat()}.xlsx"
         return Response(
@@ -3238,40 +4343,13 @@ def admin_payroll():
             headers={"Content-Disposition": f"attachment; filename={filename}"}
         )
 
-    day_headers = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-    grid_rows = []
-
-    for emp_name in sorted(weekly_map.keys(), key=lambda x: x.lower()):
-        day_cells = []
-        total_emp = 0
-
-        for wd in range(7):
-            stores_for_day = weekly_map.get(emp_name, {}).get(wd, {})
-            if not stores_for_day:
-                day_cells.append("0h 00m")
-                continue
-
-            parts = []
-            for store_name in sorted(stores_for_day.keys(), key=lambda x: x.lower()):
-                m = stores_for_day[store_name]
-                total_emp += m
-                parts.append(f"{store_name} {minutes_to_short(m)}")
-
-            day_cells.append("; ".join(parts))
-
-        grid_rows.append({
-            "employee": emp_name,
-            "days": day_cells,
-            "total": minutes_to_short(total_emp),
-        })
-
     return render_template(
         "payroll.html",
         start=start_dt.date().isoformat(),
         end=end_dt.date().isoformat(),
         summary=summary,
-        rows=rows,
-        day_headers=day_headers,
+        rows=list(iter_payroll_detail_rows(q_start, q_end)),
+        day_headers=PAYROLL_DAY_HEADERS,
         grid_rows=grid_rows,
         grand_minutes=grand_minutes,
         grand_human=grand_human,
@@ -0,0 +1,40 @@
+import os
+from contextlib import contextmanager
+
+from psycopg2.pool import SimpleConnectionPool
+
+# Shared connection handling for the one-off admin scripts (list_*, show_tables, ...).
+# The pool is created lazily on first use and reused for every cursor() in the
+# process; point DATABASE_URL at PgBouncer to keep sockets warm across runs too.
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+_pool = None
+
+def get_pool() -> SimpleConnectionPool:
+    global _pool
+    if _pool is None:
+        if not DATABASE_URL:
+            raise SystemExit("DATABASE_URL not set. Run `set DATABASE_URL=...` first.")
+        _pool = SimpleConnectionPool(1, 4, DATABASE_URL)
+    return _pool
+
+@contextmanager
+def cursor(autocommit: bool = False):
+    """
+    Yields a cursor from the pool. Commits on success, rolls back on error,
+    and always hands the connection back.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        conn.autocommit = autocommit
+        with conn.cursor() as cur:
+            yield cur
+        if not autocommit:
+            conn.commit()
+    except Exception:
+        if not autocommit:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
@@ -1,10 +1,4 @@
-import os
-import psycopg2
-
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-if not DATABASE_URL:
-    raise SystemExit("DATABASE_URL is not set. Run `set DATABASE_URL=...` first.")
+from db_cli import cursor
 
 create_tables_sql = """
 CREATE TABLE IF NOT EXISTS employees (
@@ -46,13 +40,9 @@ CREATE TABLE IF NOT EXISTS location_logs (
 
 def main():
     print("Connecting to database...")
-    conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = True
-    cur = conn.cursor()
-    print("Creating tables (if not exist)...")
-    cur.execute(create_tables_sql)
-    cur.close()
-    conn.close()
+    with cursor(autocommit=True) as cur:
+        print("Creating tables (if not exist)...")
+        cur.execute(create_tables_sql)
     print("Done! Tables created.")
 
 if __name__ == "__main__":
@@ -1,16 +1,8 @@
-import os
-import psycopg2
+from db_cli import cursor
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-if not DATABASE_URL:
-    raise SystemExit("DATABASE_URL not set. Run `set DATABASE_URL=...` first.")
-
-conn = psycopg2.connect(DATABASE_URL)
-cur = conn.cursor()
-
-cur.execute("SELECT id, name, pin FROM employees ORDER BY id;")
-rows = cur.fetchall()
+with cursor() as cur:
+    cur.execute("SELECT id, name, pin FROM employees ORDER BY id;")
+    rows = cur.fetchall()
 
 if not rows:
     print("No employees found.")
@@ -18,6 +10,3 @@ else:
     print("Employees:")
     for emp_id, name, pin in rows:
         print(f"- ID {emp_id}: {name}, PIN: {pin}")
-
-cur.close()
-conn.close()
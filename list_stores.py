@@ -1,21 +1,12 @@
-import os
-import psycopg2
+from db_cli import cursor
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-if not DATABASE_URL:
-    raise SystemExit("DATABASE_URL not set. Run `set DATABASE_URL=...` first.")
-
-conn = psycopg2.connect(DATABASE_URL)
-cur = conn.cursor()
-
-cur.execute("""
-    SELECT id, name, qr_code_token, latitude, longitude, geofence_radius_meters
-    FROM stores
-    ORDER BY id;
-""")
-
-rows = cur.fetchall()
+with cursor() as cur:
+    cur.execute("""
+        SELECT id, name, qr_code_token, latitude, longitude, geofence_radius_meters
+        FROM stores
+        ORDER BY id;
+    """)
+    rows = cur.fetchall()
 
 if not rows:
     print("No stores found.")
@@ -28,6 +19,3 @@ else:
         print(f"    lat/lng: {lat}, {lng}")
         print(f"    radius: {radius} m")
         print()
-
-cur.close()
-conn.close()
@@ -0,0 +1,7 @@
+# One-off schema maintenance (indexes, legacy-value cleanups).
+# Run once per deploy, before the web workers start (Render: Pre-Deploy Command).
+from app import app, run_schema_maintenance
+
+with app.app_context():
+    run_schema_maintenance()
+    print("✅ Schema maintenance done")
@@ -1,41 +1,57 @@
-from app import app, db, Store, Employee
+from sqlalchemy import select, literal, exists
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import app, db, Store, Employee, normalize_store_code
+
+TEST_STORE = dict(
+    name="Test Store",
+    qr_token=normalize_store_code("TEST-STORE"),  # stored lowercase, like every store token
+    latitude=36.15398,
+    longitude=-95.99277,
+    geofence_radius_m=200,
+)
+
+TEST_EMPLOYEES = [
+    dict(name="Alice Test", pin="1231"),
+    dict(name="Bob Test", pin="4561"),
+]
 
 with app.app_context():  # <-- ensures Flask knows which app to use
 
     # -------------------------
-    # Clear existing data (optional)
+    # Schema (no drop: safe to re-run against real data)
     # -------------------------
-    print("Clearing existing data...")
-    db.drop_all()
     db.create_all()
 
+    insert = pg_insert if db.engine.dialect.name == "postgresql" else sqlite_insert
+
     # -------------------------
-    # Create Test Store
+    # Test Store (qr_token is UNIQUE -> ON CONFLICT DO NOTHING)
     # -------------------------
-    store = Store(
-        name="Test Store",
-        latitude=36.15398,
-        longitude=-95.99277,
-        radius_meters=200
+    db.session.execute(
+        insert(Store).values(**TEST_STORE).on_conflict_do_nothing(index_elements=["qr_token"])
     )
-    db.session.add(store)
 
     # -------------------------
-    # Create Test Employees
-    # -------------------------
-    employees = [
-        Employee(name="Alice Test", qr_code="ALICE123"),
-        Employee(name="Bob Test", qr_code="BOB123")
-    ]
-
-    db.session.add_all(employees)
+    # Test Employees (pin isn't unique in the schema, so guard with NOT EXISTS)
+    # -------------------------
+    for emp in TEST_EMPLOYEES:
+        db.session.execute(
+            insert(Employee).from_select(
+                ["name", "pin", "active"],
+                select(literal(emp["name"]), literal(emp["pin"]), literal(True)).where(
+                    ~exists().where(Employee.pin == emp["pin"])
+                ),
+            )
+        )
 
     # -------------------------
     # Commit all changes
     # -------------------------
     db.session.commit()
 
-    print("✅ Seed data created successfully!")
-    print(f"Store: {store.name}")
-    for emp in employees:
-        print(f"Employee: {emp.name}, QR: {emp.qr_code}")
+    print("✅ Seed data ready (existing rows left untouched)")
+    print(f"Store: {TEST_STORE['name']}, QR: {TEST_STORE['qr_token']}")
+    for emp in TEST_EMPLOYEES:
+        print(f"Employee: {emp['name']}, PIN: {emp['pin']}")
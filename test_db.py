@@ -1,10 +1,8 @@
 import os
-import psycopg2
+
+from db_cli import cursor
 
 print("DATABASE_URL:", os.getenv("DATABASE_URL"))
-conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-cur = conn.cursor()
-cur.execute("SELECT NOW()")
-print("DB Connection OK, time:", cur.fetchone())
-cur.close()
-conn.close()
+with cursor() as cur:
+    cur.execute("SELECT NOW()")
+    print("DB Connection OK, time:", cur.fetchone())